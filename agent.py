@@ -1,8 +1,12 @@
 import chess
 import random
+from bitbase import Bitbases
+import telemetry
+import time
 from piece_square_tables import piece_square_table_score
-from pawn_shield_storm import eval_pawn_storm
-from typing import Callable, Dict, List
+from pawn_hash import PawnHashTable, pawn_key, update_pawn_key
+from typing import Callable, Dict, List, Optional, Tuple
+from zobrist import update_key, zobrist_key
 from collections import defaultdict
 
 piece_indices = {
@@ -72,6 +76,10 @@ def get_captured_piece(board: chess.Board, move: chess.Move):
             idx = move.from_square + 1
     return str(board.piece_at(idx))
 
+# score of a position a bitbase says is won, less its distance to mate in
+# plies, ahead of any material advantage
+BITBASE_WIN = 1000
+
 def dotProduct(d1: Dict, d2: Dict) -> float:
     """
     The dot product of two vectors represented as dictionaries. This function
@@ -89,6 +97,10 @@ def dotProduct(d1: Dict, d2: Dict) -> float:
         return sum(d1.get(f, 0) * v for f, v in list(d2.items()))
 
 
+class SearchStopped(Exception):
+    """Raised inside min_maxN when the agent's should_stop callback fires."""
+    pass
+
 class Agent():
     def __init__(self, name: str):
         self.piece_count = None
@@ -119,18 +131,183 @@ class MiniMaxAgent(Agent):
             "pawn_storm": 0,
             "piece_square": 0,
         }
+        # nodes visited by the current search and an optional callback polled
+        # during search so that a caller (e.g. the UCI front-end) can abort it
+        self.nodes = 0
+        self.eval_time = 0.0
+        self.should_stop: Optional[Callable[[], bool]] = None
+        self.last_score = None
+        # pawn/king terms are cached in pawn_table, created on first use. While
+        # searching, pawn_key holds the pawn/king Zobrist key of the search
+        # board, outside of a search it is None and computed from the board
+        self.pawn_table: Optional[PawnHashTable] = None
+        self.pawn_table_size = 1 << 16
+        self.pawn_key: Optional[int] = None
+        # endgame bitbases (see bitbase.py) are probed when bitbase_dir is set,
+        # they are memory-mapped on first use
+        self.bitbase_dir: Optional[str] = None
+        self.bitbases: Optional[Bitbases] = None
+        # while searching, key is the Zobrist key of the search board,
+        # repetitions counts the keys of the positions on the current path
+        # after the root, and game_positions those of the root and the game
+        # positions before it since the last irreversible move
+        self.key: Optional[int] = None
+        self.repetitions: Dict[int, int] = dict()
+        self.game_positions: Dict[int, int] = dict()
+
+    def __getstate__(self):
+        # the pawn table is only a cache and memory maps can't be pickled,
+        # don't ship either to and from pool workers
+        state = dict(self.__dict__)
+        state["pawn_table"] = None
+        state["bitbases"] = None
+        return state
+
+    def probe_bitbases(self, board: chess.Board) -> Optional[float]:
+        '''
+        Score of board from the bitbases, or None if they don't cover it
+        '''
+        if self.bitbase_dir is None:
+            return None
+        if self.bitbases is None:
+            self.bitbases = Bitbases(self.bitbase_dir)
+        result = self.bitbases.probe_distance(board)
+        if result is None:
+            return None
+        wdl, distance = result
+        if wdl == 0:
+            return 0
+        if distance == 0:
+            # checkmate
+            return float('-inf') if board.turn == chess.WHITE else float('inf')
+        # the sooner the win the better, so that winning moves make progress
+        score = BITBASE_WIN - distance
+        winner = board.turn if wdl > 0 else not board.turn
+        return score if winner == chess.WHITE else -score
+
+    def start_search(self):
+        self.nodes = 0
+        self.eval_time = 0.0
+        self.pawn_key = pawn_key(self.board) if self.weights["pawn_storm"] > 0.0 else None
+        self.key = zobrist_key(self.board)
+        self.repetitions = dict()
+        self.game_positions = {self.key: 1}
+        # positions before the last pawn move or capture can't come back
+        board = self.board.copy()
+        for _ in range(min(board.halfmove_clock, len(board.move_stack))):
+            board.pop()
+            key = zobrist_key(board)
+            self.game_positions[key] = self.game_positions.get(key, 0) + 1
+
+    def enter_position(self, key: int):
+        self.repetitions[key] = self.repetitions.get(key, 0) + 1
+
+    def leave_position(self, key: int):
+        count = self.repetitions[key] - 1
+        if count > 0:
+            self.repetitions[key] = count
+        else:
+            del self.repetitions[key]
+
+    def is_rule_draw(self, board: chess.Board) -> bool:
+        '''
+        Whether board, just pushed with its key in self.key, is a draw by
+        repetition or the fifty-move rule. Repeating a position of the path
+        after the root once counts as a draw, since repeating once can only be
+        worth repeating again. A position from the game (or the root) only
+        counts once it has occurred twice, as the opponent may have stepped
+        back into it without the game being drawn.
+        '''
+        if self.key in self.repetitions or self.game_positions.get(self.key, 0) >= 2:
+            return True
+        return board.halfmove_clock >= 100 and not board.is_checkmate()
+
+    def make_eval_fn(self) -> Callable[[], float]:
+        eval_fn = lambda: self.eval_board(self.board, self.piece_count)
+        if telemetry.recorder is None:
+            return eval_fn
+        # only pay for timing every leaf when telemetry is being recorded
+        def timed_eval_fn():
+            start = time.perf_counter()
+            score = eval_fn()
+            self.eval_time += time.perf_counter() - start
+            return score
+        return timed_eval_fn
+
+    def pawn_storm(self, board: chess.Board) -> float:
+        if self.pawn_table is None:
+            self.pawn_table = PawnHashTable(self.pawn_table_size)
+        key = self.pawn_key if self.pawn_key is not None else pawn_key(board)
+        return self.pawn_table.lookup(key, board)[0]
 
     def featureExtractor(self, piece_count: List[int], board: chess.Board):
         return {
-            "piece_count": eval_piece_count(self.piece_count),
-            "pawn_storm": eval_pawn_storm(board) if self.weights["pawn_storm"] > 0.0 else 0,
+            "piece_count": eval_piece_count(piece_count),
+            "pawn_storm": self.pawn_storm(board) if self.weights["pawn_storm"] > 0.0 else 0,
             "piece_square": piece_square_table_score(board, piece_count) if self.weights["piece_square"] > 0.0 else 0
         }
 
     # simple evaluation function
     def eval_board(self, board: chess.Board, piece_count: List[int]):
+        score = self.probe_bitbases(board)
+        if score is not None:
+            return score
         return dotProduct(self.featureExtractor(piece_count, board), self.weights)
 
+    def search_child(
+            self,
+            board: chess.Board,
+            piece_count: List[int],
+            move: chess.Move,
+            depth: int,
+            eval_fn: Callable[[chess.Board, List[int]], float],
+            alpha: float,
+            beta: float) -> float:
+        '''
+        Score of playing move on board, searched depth plies further. Leaves
+        board, piece_count and the search keys as it found them.
+        '''
+        # if the move is a capture, decrement the count of the captured piece
+        captured_piece = None
+        if board.is_capture(move):
+            captured_piece = get_captured_piece(board, move)
+            piece_count[piece_indices[captured_piece]] -= 1
+
+        parent_pawn_key = self.pawn_key
+        if parent_pawn_key is not None:
+            self.pawn_key = update_pawn_key(parent_pawn_key, board, move)
+        parent_key = self.key
+        self.key = update_key(parent_key, board, move)
+
+        board.push(move)
+
+        if self.is_rule_draw(board):
+            # cycles and fifty-move draws aren't searched any further
+            score = 0
+        else:
+            self.enter_position(self.key)
+            # positions in the bitbases are resolved exactly, without searching further
+            score = self.probe_bitbases(board)
+            if score is None:
+                # recursive call delegating to the other player
+                score, _ = self.min_maxN(
+                    board=board,
+                    piece_count=piece_count,
+                    depth=depth,
+                    eval_fn=eval_fn,
+                    alpha=alpha,
+                    beta=beta)
+            self.leave_position(self.key)
+
+        board.pop()
+        self.pawn_key = parent_pawn_key
+        self.key = parent_key
+
+        # reset board and piece count
+        if captured_piece is not None:
+            piece_count[piece_indices[captured_piece]] += 1
+        return score
+
     def min_maxN(
             self,
             board: chess.Board,
@@ -139,6 +316,9 @@ class MiniMaxAgent(Agent):
             eval_fn: Callable[[chess.Board, List[int]], float],
             alpha: float,
             beta: float):
+        self.nodes += 1
+        if (self.should_stop is not None and (self.nodes & 1023) == 0 and self.should_stop()):
+            raise SearchStopped()
         if (board.is_stalemate() or board.is_insufficient_material()):
             return (0, None)
         if (board.is_checkmate()):
@@ -151,28 +331,7 @@ class MiniMaxAgent(Agent):
         scores = []
 
         for move in moves:
-            # if the move is a capture, decrement the count of the captured piece
-            captured_piece = None
-            if board.is_capture(move):
-                captured_piece = get_captured_piece(board, move)
-                piece_count[piece_indices[captured_piece]] -= 1
-
-            board.push(move)
-
-            # recursive call delegating to the other player
-            score, _ = self.min_maxN(
-                board=board,
-                piece_count=piece_count,
-                depth=depth - 1,
-                eval_fn=eval_fn,
-                alpha=alpha,
-                beta=beta)
-
-            board.pop()
-
-            # reset board and piece count
-            if captured_piece is not None:
-                piece_count[piece_indices[captured_piece]] += 1
+            score = self.search_child(board, piece_count, move, depth - 1, eval_fn, alpha, beta)
 
             if (board.turn == chess.WHITE): # max
                 if (score >= beta): #prune
@@ -190,22 +349,88 @@ class MiniMaxAgent(Agent):
         return (bestScore, moves[scores.index(bestScore)])
 
     def get_move(self):
-        _, move = self.min_maxN(
+        self.start_search()
+        start = telemetry.now()
+        score, move = self.min_maxN(
             board=self.board,
             piece_count=self.piece_count,
             depth=self.depth*2,
-            eval_fn=lambda: self.eval_board(self.board, self.piece_count),
+            eval_fn=self.make_eval_fn(),
             alpha=float('-inf'),
             beta=float('inf'))
+        telemetry.record(f"depth {self.depth*2}", "search", start, telemetry.now(), agent=self.name(), depth=self.depth*2, nodes=self.nodes)
+        self.pawn_key = None
+        # kept so that callers can record what the agent thought of its move
+        self.last_score = score
         return move
 
+    def analyse(self, depth: int, multipv: int = 1) -> Tuple[float, List[Tuple[chess.Move, float]]]:
+        '''
+        Returns the static evaluation of the current board and its multipv best
+        moves, best first, each scored by a depth ply search. With multipv > 1
+        every root move gets a full window search, so its score is exact
+        rather than a bound.
+        '''
+        self.start_search()
+        static = self.eval_board(self.board, self.piece_count)
+        eval_fn = self.make_eval_fn()
+        if multipv == 1 or depth == 0:
+            score, move = self.min_maxN(self.board, self.piece_count, depth, eval_fn, float('-inf'), float('inf'))
+            self.pawn_key = None
+            return (static, [(move, score)] if move is not None else [])
+
+        scored = []
+        for move in list(self.board.legal_moves):
+            score = self.search_child(self.board, self.piece_count, move, depth - 1, eval_fn, float('-inf'), float('inf'))
+            scored.append((move, score))
+        scored.sort(key=lambda item: item[1], reverse=(self.board.turn == chess.WHITE))
+        self.pawn_key = None
+        return (static, scored[:multipv])
+
+    def iterative_deepening(
+            self,
+            max_depth: int,
+            on_iteration: Optional[Callable[[int, float, chess.Move], None]] = None) -> Tuple[float, Optional[chess.Move], int]:
+        '''
+        Searches the current board at 1, 2, ..., max_depth plies and returns
+        (score, move, depth) of the deepest search that finished. If
+        should_stop fires part way through an iteration, that iteration is
+        thrown away and the previous one is returned.
+        '''
+        self.start_search()
+        root_ply = len(self.board.move_stack)
+        root_piece_count = list(self.piece_count)
+        best = (0, None, 0)
+        for depth in range(1, max_depth + 1):
+            if depth > 1 and self.should_stop is not None and self.should_stop():
+                break
+            start = telemetry.now()
+            nodes = self.nodes
+            try:
+                score, move = self.min_maxN(
+                    board=self.board,
+                    piece_count=self.piece_count,
+                    depth=depth,
+                    eval_fn=self.make_eval_fn(),
+                    alpha=float('-inf'),
+                    beta=float('inf'))
+            except SearchStopped:
+                # min_maxN unwinds without undoing its moves, so restore the
+                # board and piece count to the root position
+                while len(self.board.move_stack) > root_ply:
+                    self.board.pop()
+                self.piece_count[:] = root_piece_count
+                break
+            best = (score, move, depth)
+            telemetry.record(f"depth {depth}", "search", start, telemetry.now(), agent=self.name(), depth=depth, nodes=self.nodes - nodes)
+            if on_iteration is not None:
+                on_iteration(depth, score, move)
+            if move is None:
+                break
+        self.pawn_key = None
+        return best
+
 class MinimaxAgentWithPieceSquareTables(MiniMaxAgent):
     def __init__(self, name, depth: int):
         super().__init__(name, depth)
         self.weights["piece_square"] = 1
-
-# def iterative_deepening():
-#     depth = 2
-#     while(True):
-#         min_maxN(board,N, lambda: eval_piece_count(piece_count), float('-inf'), float('inf'), piece_count)[1]
-#         depth += 2
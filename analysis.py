@@ -0,0 +1,100 @@
+import chess
+from agent import MiniMaxAgent
+from multiprocessing import Pool, cpu_count
+from typing import Dict, List, Optional, Tuple
+
+'''
+Position analysis with our own agents, cheap enough to run over whole
+chunks. Scores are in pawns from white's point of view, like the agents'
+eval_board, with +/-inf for a forced mate.
+
+evaluate_positions.py uses prefilter to throw away clearly unbalanced
+positions before they reach Stockfish.
+'''
+
+# default limits for analyse: search depth in plies and number of moves to return
+default_limits = {
+    "depth": 2,
+    "multipv": 1,
+}
+
+def make_agent(weights: Optional[Dict[str, float]] = None) -> MiniMaxAgent:
+    agent = MiniMaxAgent("analysis", depth=1)
+    if weights is not None:
+        agent.weights.update(weights)
+    return agent
+
+def analyse(fen: str, limits: Optional[Dict[str, int]] = None, agent: Optional[MiniMaxAgent] = None):
+    '''
+    Returns {"fen", "static", "score", "depth", "moves"} where static is the
+    evaluation of the position itself, score the score of the best move and
+    moves a list of (move, score), best first.
+    '''
+    limits = dict(default_limits, **(limits or {}))
+    agent = agent if agent is not None else make_agent()
+    board = chess.Board(fen)
+    agent.initialize(board)
+    static, moves = agent.analyse(limits["depth"], limits["multipv"])
+    return {
+        "fen": fen,
+        "static": static,
+        "score": moves[0][1] if moves else static,
+        "depth": limits["depth"],
+        "moves": moves,
+    }
+
+def is_balanced(analysis, margin: float) -> bool:
+    '''
+    True if the best move's score is within margin pawns of equal
+    '''
+    return abs(analysis["score"]) <= margin
+
+# per process agent for analyse_batch, so that its pawn table survives across positions
+_batch_agent = None
+_batch_limits = None
+
+def _init_batch(weights, limits):
+    global _batch_agent, _batch_limits
+    _batch_agent = make_agent(weights)
+    _batch_limits = limits
+
+def _analyse_one(fen: str):
+    return analyse(fen, _batch_limits, _batch_agent)
+
+def analyse_batch(
+        fens: List[str],
+        limits: Optional[Dict[str, int]] = None,
+        weights: Optional[Dict[str, float]] = None,
+        processes: int = cpu_count()):
+    '''
+    Analyses fens in parallel, returning the analyses in the same order
+    '''
+    with Pool(processes=processes, initializer=_init_batch, initargs=(weights, limits)) as pool:
+        return pool.map(_analyse_one, fens, chunksize=max(1, len(fens) // (4 * processes)))
+
+def prefilter(
+        positions: List[Tuple[str, str]],
+        margin: float = 2.0,
+        limits: Optional[Dict[str, int]] = None,
+        weights: Optional[Dict[str, float]] = None,
+        processes: Optional[int] = None):
+    '''
+    Splits (opening, fen) positions into (borderline, discarded): discarded
+    positions are more than margin pawns from equal after a shallow search
+    and are not worth an engine's time. With processes=None the positions
+    are analysed in this process, e.g. when already inside a pool worker.
+    '''
+    fens = [fen for _, fen in positions]
+    if processes is None:
+        agent = make_agent(weights)
+        analyses = [analyse(fen, limits, agent) for fen in fens]
+    else:
+        analyses = analyse_batch(fens, limits, weights, processes)
+    borderline = []
+    discarded = []
+    for position, analysis in zip(positions, analyses):
+        if is_balanced(analysis, margin):
+            borderline.append(position)
+        else:
+            discarded.append(position)
+    return (borderline, discarded)
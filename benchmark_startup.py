@@ -0,0 +1,44 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+'''
+Measures what a headless tournament pays before the first game starts:
+the import time of bestchess in a fresh interpreter, the cost of the
+modules it no longer imports (pygame, tqdm, numpy), and how long a pool of
+freshly spawned workers takes to come up and simulate their first game.
+'''
+
+def import_time(statement: str, repeats: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True, env=dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1"))
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def loaded_modules(_):
+    import bestchess
+    return sorted({name.split('.')[0] for name in sys.modules} & {"pygame", "tqdm", "numpy"})
+
+def spawn_time(num_workers: int) -> float:
+    from bestchess import simulate_game
+    from agent import RandomAgent
+    fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+    games = [("start", fen, RandomAgent("a"), RandomAgent("b"))] * num_workers
+    start = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(processes=num_workers) as pool:
+        pool.map(simulate_game, games, chunksize=1)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    num_workers = multiprocessing.cpu_count()
+    interpreter = import_time("pass")
+    print(f"python startup:               {interpreter * 1000:7.1f} ms")
+    print(f"import bestchess:             {(import_time('import bestchess') - interpreter) * 1000:7.1f} ms")
+    print(f"import pygame, tqdm, numpy:   {(import_time('import pygame, tqdm, numpy') - interpreter) * 1000:7.1f} ms  (no longer paid headless)")
+    with multiprocessing.get_context("spawn").Pool(processes=1) as pool:
+        print(f"heavy modules in a worker:    {pool.map(loaded_modules, [None])[0]}")
+    print(f"spawn {num_workers} workers + 1 game each: {spawn_time(num_workers) * 1000:7.1f} ms")
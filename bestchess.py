@@ -3,12 +3,17 @@ from copy import deepcopy
 from typing import Optional
 from agent import Agent, MiniMaxAgent, RandomAgent, MinimaxAgentWithPieceSquareTables
 from collections import defaultdict
-from graphics import ChessGraphics
 from multiprocessing import Pool, cpu_count
 import random
+import telemetry
+import threading
+import time
 from typing import List, Tuple
+from game_archive import GameArchiveWriter, GameRecord
+from mcts_agent import MCTSAgent
+from sprt import SPRT
 from util import read_positions
-from tqdm import tqdm
+from zobrist import zobrist_key
 
 class ChessGame():
     def __init__(self, player1: Optional[Agent] = None, player2: Optional[Agent] = None, useGraphics: bool = True, startingFen: Optional[str] = None):
@@ -17,7 +22,19 @@ class ChessGame():
         self.board = chess.Board()
         if (startingFen):
             self.board.set_fen(startingFen)
-        self.graphics = ChessGraphics(board=self.board) if (useGraphics or player1 is None or player2 is None) else None
+        self.startingFen = startingFen
+        # time taken and score reported by the agent for each move, None for human moves
+        self.move_times = []
+        self.move_evals = []
+        # how often each position since the last irreversible move has occurred
+        self.key = zobrist_key(self.board)
+        self.repetitions = {self.key: 1}
+        self.graphics = None
+        if (useGraphics or player1 is None or player2 is None):
+            # imported here so that headless games (and every pool worker
+            # simulating them) never load pygame
+            from graphics import ChessGraphics
+            self.graphics = ChessGraphics(board=self.board)
         if (self.player1 is not None):
             self.player1.initialize(board=self.board)
         if (self.player2 is not None):
@@ -26,25 +43,60 @@ class ChessGame():
     def run(self):
         status = True
         winner = None
+        thinker = None
         while (status):
             if (self.graphics is not None):
                 self.graphics.draw_game()
-            if self.board.turn == chess.WHITE:
-                if (self.player1 is not None):
-                    self.board.push(self.player1.get_move())
-                else:
-                    status = self.graphics.capture_human_interaction()
+            plies = len(self.board.move_stack)
+            player = self.player1 if self.board.turn == chess.WHITE else self.player2
+            if (player is None):
+                status = self.graphics.capture_human_interaction()
+                if len(self.board.move_stack) != plies:
+                    self.move_times.append(None)
+                    self.move_evals.append(None)
+            elif (self.graphics is None):
+                span_start = telemetry.now()
+                start = time.perf_counter()
+                move = player.get_move()
+                self.move_times.append(time.perf_counter() - start)
+                self.move_evals.append(getattr(player, "last_score", None))
+                if telemetry.recorder is not None:
+                    depth = getattr(player, "depth", None)
+                    telemetry.record(
+                        "move", "move", span_start, telemetry.now(),
+                        agent=player.name(),
+                        ply=plies,
+                        phase=telemetry.game_phase(chess.popcount(self.board.occupied)),
+                        depth=depth * 2 if depth is not None else None,
+                        nodes=getattr(player, "nodes", None),
+                        eval_time=getattr(player, "eval_time", None))
+                self.board.push(move)
             else:
-                if (self.player2 is not None):
-                    self.board.push(self.player2.get_move())
-                else:
-                    status = self.graphics.capture_human_interaction()
+                # search in the background so that the window keeps responding
+                if (thinker is None):
+                    thinker = AgentThinker(player)
+                status = self.graphics.pump_events()
+                self.graphics.show_thinking(thinker.status())
+                if (thinker.done):
+                    self.board.push(thinker.result())
+                    self.move_times.append(thinker.elapsed)
+                    self.move_evals.append(thinker.score)
+                    self.graphics.last_move = thinker.move
+                    self.graphics.show_thinking(None)
+                    thinker = None
         
-            if self.board.outcome() != None:
-                # print(self.board.outcome())
-                status = False
-                # print(self.board)
-                winner = self.board.outcome().winner
+            if len(self.board.move_stack) != plies:
+                self.add_position()
+                outcome = self.outcome()
+                if outcome is not None:
+                    status = False
+                    winner = outcome.winner
+            if (self.graphics is not None):
+                self.graphics.wait_frame()
+        if (thinker is not None):
+            thinker.cancel()
+        if (self.graphics is not None):
+            self.graphics.draw_game()
         if (winner == None):
             return None
         if (chess.WHITE == winner):
@@ -52,15 +104,128 @@ class ChessGame():
         else:
             return self.player2.name() if (self.player2 is not None) else "black"
 
-# Simulate a single game and return the winner
+    def add_position(self):
+        self.key = zobrist_key(self.board)
+        if self.board.halfmove_clock == 0:
+            # pawn move or capture, no earlier position can repeat
+            self.repetitions.clear()
+        self.repetitions[self.key] = self.repetitions.get(self.key, 0) + 1
+
+    def outcome(self) -> Optional[chess.Outcome]:
+        '''
+        Like board.outcome(), but threefold repetitions and the fifty-move rule
+        end the game as draws, and repetitions are counted as the game goes
+        rather than by replaying the move stack after every move
+        '''
+        if not any(self.board.generate_legal_moves()):
+            if self.board.is_check():
+                return chess.Outcome(chess.Termination.CHECKMATE, not self.board.turn)
+            return chess.Outcome(chess.Termination.STALEMATE, None)
+        if self.board.is_insufficient_material():
+            return chess.Outcome(chess.Termination.INSUFFICIENT_MATERIAL, None)
+        if self.repetitions[self.key] >= 3:
+            return chess.Outcome(chess.Termination.THREEFOLD_REPETITION, None)
+        if self.board.halfmove_clock >= 100:
+            return chess.Outcome(chess.Termination.FIFTY_MOVES, None)
+        return None
+
+    def record(self) -> GameRecord:
+        '''
+        Returns the game played so far in a form that can be archived
+        '''
+        outcome = self.outcome()
+        return GameRecord(
+            white=self.player1.name() if (self.player1 is not None) else "human",
+            black=self.player2.name() if (self.player2 is not None) else "human",
+            result=outcome.result() if outcome is not None else "*",
+            moves=list(self.board.move_stack),
+            fen=self.startingFen,
+            evals=self.move_evals,
+            times=self.move_times)
+
+class AgentThinker():
+    '''
+    Runs an agent's search on a worker thread, against a copy of the board
+    so that the game's board can be drawn while the agent thinks. Minimax
+    agents search by iterative deepening, which ends on the same move as
+    get_move but reports the depth, score and best move so far.
+    '''
+    def __init__(self, agent: Agent):
+        self.agent = agent
+        self.move = None
+        self.done = False
+        self.cancelled = False
+        self.depth = 0
+        self.score = None
+        self.best_move = None
+        self.elapsed = None
+        self.error = None
+        self.thread = threading.Thread(target=self.think, daemon=True)
+        self.thread.start()
+
+    def think(self):
+        start = time.perf_counter()
+        board = self.agent.board
+        self.agent.board = board.copy()
+        try:
+            if isinstance(self.agent, MiniMaxAgent):
+                self.agent.should_stop = lambda: self.cancelled
+                _, self.move, _ = self.agent.iterative_deepening(self.agent.depth*2, on_iteration=self.on_iteration)
+            else:
+                self.move = self.agent.get_move()
+                self.score = getattr(self.agent, "last_score", None)
+        except Exception as error:
+            # kept for the main thread, which re-raises it in result()
+            self.error = error
+        finally:
+            if isinstance(self.agent, MiniMaxAgent):
+                self.agent.should_stop = None
+            self.agent.board = board
+            self.elapsed = time.perf_counter() - start
+            self.done = True
+
+    def result(self) -> chess.Move:
+        '''
+        The move found, once done is set. Raises whatever the search raised.
+        '''
+        if self.error is not None:
+            raise self.error
+        return self.move
+
+    def on_iteration(self, depth: int, score: float, move: chess.Move):
+        self.depth = depth
+        self.score = score
+        self.best_move = move
+
+    def status(self) -> str:
+        if self.best_move is None:
+            return f"{self.agent.name()} thinking..."
+        return f"{self.agent.name()} thinking... depth {self.depth} score {self.score:+.2f} best {self.best_move.uci()}"
+
+    def cancel(self):
+        self.cancelled = True
+        self.thread.join()
+
+# Simulate a single game and return the winner along with the game record
 def simulate_game(data):
     opening,fen,player1,player2 = data
-    result = ChessGame(
-        player1=player1,
-        player2=player2,
-        useGraphics=False,
-        startingFen=fen).run()
-    return (opening, result, player1)
+    with telemetry.span("game", "game", opening=opening, white=player1.name(), black=player2.name()) as args:
+        game = ChessGame(
+            player1=player1,
+            player2=player2,
+            useGraphics=False,
+            startingFen=fen)
+        result = game.run()
+        args["result"] = result
+        args["plies"] = len(game.board.move_stack)
+    # one batch of spans per game
+    telemetry.flush()
+    return (opening, result, player1, game.record())
+
+# Simulate one game of an opening pair, tagged with the pair it belongs to
+def simulate_pair_game(data):
+    pair_id, game = data
+    return (pair_id, simulate_game(game))
 
 def aggregate(positions: List[Tuple[str, str]]):
     opening_map = defaultdict(lambda: list())
@@ -68,21 +233,14 @@ def aggregate(positions: List[Tuple[str, str]]):
         opening_map[opening].append(fen)
     return opening_map
 
-if __name__ == "__main__":
-    num_games = 256
-    num_chunks = 4
-    assert num_games % num_chunks == 0
-    num_games //= num_chunks
-    numWorkers = cpu_count()  # Adjust this to the number of CPU cores you want to use
-    print(numWorkers)
-    
-    agent1 = RandomAgent("RandAgent1")
-    agent2 = RandomAgent("RandAgent2")
-    # agent1 = MinimaxAgentWithPieceSquareTables("psquaretables", depth=2)
-    # agent2 = MiniMaxAgent("mma", depth=2)
-    
+def build_pairs(agent1: Agent, agent2: Agent, num_games: int, num_chunks: int):
+    '''
+    Picks num_games openings from each of num_chunks random chunks and
+    returns a list of pairs of games, each opening being played once with
+    each agent as white.
+    '''
     chunks = random.sample(range(1, 21), num_chunks)
-    positions_to_play = []
+    pairs = []
     for chunk in chunks:
         positions = read_positions(f"positions/unprocessed/chunk_{chunk}.txt")
         opening_map = aggregate(positions)
@@ -96,20 +254,49 @@ if __name__ == "__main__":
         player2_as_white = deepcopy(player1_as_white)
         for i in range(num_games):
             player2_as_white[i] = (player2_as_white[i][0], player2_as_white[i][1], player2_as_white[i][3], player2_as_white[i][2])
-        
-        positions_to_play.extend(player1_as_white)
-        positions_to_play.extend(player2_as_white)
+        pairs.extend(zip(player1_as_white, player2_as_white))
+    return pairs
+
+def start_telemetry(numWorkers: int, telemetry_path: Optional[str], pool):
+    '''
+    Returns (pool, collector), with a local pool whose workers record
+    telemetry if telemetry_path is set
+    '''
+    if telemetry_path is None or pool is not None:
+        if telemetry_path is not None:
+            print("Telemetry is only recorded with a local pool")
+        return (pool if pool is not None else Pool(processes=numWorkers), None)
+    collector = telemetry.Collector()
+    pool = Pool(processes=numWorkers, initializer=telemetry.init_worker, initargs=(collector.queue,))
+    return (pool, collector)
+
+def finish_telemetry(collector, telemetry_path: Optional[str]):
+    if collector is None:
+        return
+    collector.close()
+    collector.export_chrome_trace(telemetry_path)
+    print(collector.summary())
+    print(f"Trace written to {telemetry_path}")
+
+def run_tournament(agent1: Agent, agent2: Agent, pairs, numWorkers: int, archive_path: Optional[str] = None, pool = None, telemetry_path: Optional[str] = None):
+    from tqdm import tqdm
+    positions_to_play = [game for game, _ in pairs] + [game for _, game in pairs]
 
     # Run games in parallel with a progress bar and running tally
     total_games = len(positions_to_play)
     games_played = 0
     winnerMap = defaultdict(lambda : {"WHITE": 0, "BLACK": 0})
+    archive = GameArchiveWriter(archive_path) if archive_path is not None else None
 
-    with Pool(processes=numWorkers) as pool:
+    # pool can be any object with Pool's imap_unordered, such as distributed.DistributedPool
+    pool, collector = start_telemetry(numWorkers, telemetry_path, pool)
+    with pool:
         with tqdm(total=total_games, desc=f"Simulating {total_games} games") as pbar:
-            for opening, winner, player1 in pool.imap_unordered(simulate_game, positions_to_play):
+            for opening, winner, player1, record in pool.imap_unordered(simulate_game, positions_to_play):
                 # Update running tally
                 games_played += 1
+                if archive is not None:
+                    archive.add_game(record)
 
                 if winner == player1.name():
                     winnerMap[winner]["WHITE"] += 1    
@@ -132,9 +319,103 @@ if __name__ == "__main__":
                 pbar.set_postfix_str(f"Agent 1 as white: {a1_wins_w}-{a1_losses_w}-{a1_ties_w}, Agent 1 as black: {a1_wins_b}-{a1_losses_b}-{a1_ties_b}")
                 pbar.update(1)
 
+    if archive is not None:
+        archive.close()
+    finish_telemetry(collector, telemetry_path)
+
     # Final results
     for winner, count in winnerMap.items():
         if winner is None:
             print(f"Agents tied {count}/{total_games}")
         else:
             print(f"{winner} won {count}/{total_games}")
+
+def run_sprt_tournament(agent1: Agent, agent2: Agent, pairs, numWorkers: int, sprt: SPRT, archive_path: Optional[str] = None, pool = None, telemetry_path: Optional[str] = None):
+    '''
+    Plays the pairs until the SPRT accepts H0 or H1 (or the pairs run out),
+    scoring every game from agent1's point of view. The two games of a pair
+    are queued next to each other so that pairs complete at roughly the
+    same rate as games.
+    '''
+    from tqdm import tqdm
+    positions_to_play = []
+    for pair_id, (game1, game2) in enumerate(pairs):
+        positions_to_play.append((pair_id, game1))
+        positions_to_play.append((pair_id, game2))
+
+    total_games = len(positions_to_play)
+    pending = dict()
+    status = None
+    archive = GameArchiveWriter(archive_path) if archive_path is not None else None
+
+    # leaving the Pool context terminates the workers, which cancels all
+    # outstanding games once a bound has been crossed
+    # pool can be any object with Pool's imap_unordered, such as distributed.DistributedPool
+    pool, collector = start_telemetry(numWorkers, telemetry_path, pool)
+    with pool:
+        with tqdm(total=total_games, desc=f"SPRT({sprt.elo0}, {sprt.elo1}) up to {total_games} games") as pbar:
+            for pair_id, (opening, winner, player1, record) in pool.imap_unordered(simulate_pair_game, positions_to_play):
+                if archive is not None:
+                    archive.add_game(record)
+                if winner is None:
+                    score = 0.5
+                else:
+                    score = 1.0 if winner == agent1.name() else 0.0
+                pbar.update(1)
+
+                if pair_id not in pending:
+                    pending[pair_id] = score
+                    continue
+                sprt.add_pair(pending.pop(pair_id), score)
+                pbar.set_postfix_str(sprt.summary())
+
+                status = sprt.status()
+                if status is not None:
+                    break
+
+    if archive is not None:
+        archive.close()
+    finish_telemetry(collector, telemetry_path)
+
+    if status == "H1":
+        print(f"H1 accepted: {agent1.name()} is stronger than {agent2.name()}")
+    elif status == "H0":
+        print(f"H0 accepted: {agent1.name()} is not stronger than {agent2.name()}")
+    else:
+        print("SPRT inconclusive, ran out of games")
+    print(sprt.summary())
+
+if __name__ == "__main__":
+    num_games = 256
+    num_chunks = 4
+    assert num_games % num_chunks == 0
+    num_games //= num_chunks
+    numWorkers = cpu_count()  # Adjust this to the number of CPU cores you want to use
+    print(numWorkers)
+
+    # stop as soon as the result is clear instead of playing all num_games,
+    # which then becomes the maximum number of games
+    use_sprt = False
+    sprt = SPRT(elo0=0, elo1=10, alpha=0.05, beta=0.05, pentanomial=True)
+    # set to a path such as "games.fca" to keep every game, see game_archive.py
+    archive_path = None
+    # set to a path such as "trace.json" to see where the time goes, open it
+    # in chrome://tracing or https://ui.perfetto.dev
+    telemetry_path = None
+
+    agent1 = RandomAgent("RandAgent1")
+    agent2 = RandomAgent("RandAgent2")
+    # agent1 = MinimaxAgentWithPieceSquareTables("psquaretables", depth=2)
+    # agent2 = MiniMaxAgent("mma", depth=2)
+    # for a match at equal wall time, give MCTS the minimax agent's average
+    # time per move (see ChessGame.move_times)
+    # agent1 = MCTSAgent("mcts", time_limit=0.5)
+    # minimax agents resolve KPK, KRK and KQK exactly with bitbases generated
+    # by `python bitbase.py --out bitbases`
+    # agent1.bitbase_dir = agent2.bitbase_dir = "bitbases"
+
+    pairs = build_pairs(agent1, agent2, num_games, num_chunks)
+    if use_sprt:
+        run_sprt_tournament(agent1, agent2, pairs, numWorkers, sprt, archive_path, telemetry_path=telemetry_path)
+    else:
+        run_tournament(agent1, agent2, pairs, numWorkers, archive_path, telemetry_path=telemetry_path)
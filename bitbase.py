@@ -0,0 +1,478 @@
+import argparse
+import chess
+import mmap
+import os
+import random
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+'''
+Endgame bitbases: win/draw/loss tables for small endings, generated locally
+by retrograde analysis and probed from the search and the evaluation.
+
+An ending is named by the pieces of its stronger side followed by those of
+the weaker side, each starting with the king, e.g. KPK, KRK, KQK or KQKR.
+Tables are stored with the stronger side as white, positions with the
+colors the other way round are mirrored before probing. The white king is
+kept on files a-d (the rest of the board is mirrored onto them), so a
+table has 2 * 32 * 64^(pieces - 1) entries, one per side to move and
+placement. The file holds the values packed four to a byte:
+
+    0 draw, 1 win for the side to move, 2 loss for the side to move, 3 illegal
+
+followed by one byte per entry with the distance of won and lost positions:
+the number of plies to mate with best play (a win as fast as possible, a
+loss as slowly as possible), counted through captures and promotions into
+smaller endings and capped at MAX_DISTANCE. A search comparing winning
+moves by distance makes progress instead of shuffling between them.
+
+Castling and en passant are not part of the tables, positions where either
+is possible are never probed. Captures and promotions lead into smaller
+endings, which are generated first (endings with insufficient material are
+draws and need no table).
+
+Generation is pure Python and takes about a minute per 3 piece ending, a 4
+piece ending is 64 times larger and takes correspondingly longer.
+'''
+
+DRAW = 0
+WIN = 1
+LOSS = 2
+ILLEGAL = 3
+
+MAX_DISTANCE = 254
+# marks entries whose distance hasn't been found (yet) during generation
+UNRESOLVED = 255
+
+# probe results, from the point of view of the side to move
+wdl_values = {DRAW: 0, WIN: 1, LOSS: -1}
+
+piece_order = [chess.QUEEN, chess.ROOK, chess.BISHOP, chess.KNIGHT, chess.PAWN]
+piece_values = {chess.QUEEN: 9, chess.ROOK: 5, chess.BISHOP: 3, chess.KNIGHT: 3, chess.PAWN: 1}
+
+DEFAULT_ENDINGS = ["KPK", "KRK", "KQK"]
+
+def side_name(board: chess.Board, color: chess.Color) -> str:
+    name = "K"
+    for piece_type in piece_order:
+        name += chess.piece_symbol(piece_type).upper() * chess.popcount(board.pieces_mask(piece_type, color))
+    return name
+
+def side_value(name: str) -> Tuple[int, str]:
+    return (sum(piece_values[chess.PIECE_SYMBOLS.index(symbol.lower())] for symbol in name[1:]), name)
+
+def split_name(name: str) -> Tuple[str, str]:
+    weak = name.index("K", 1)
+    return (name[:weak], name[weak:])
+
+def ending_name(board: chess.Board) -> Tuple[str, bool]:
+    '''
+    Returns the name of the ending on board and whether the board has to be
+    mirrored to put the stronger side on white
+    '''
+    return canonical_name(side_name(board, chess.WHITE), side_name(board, chess.BLACK))
+
+def canonical_name(white: str, black: str) -> Tuple[str, bool]:
+    if side_value(black) > side_value(white):
+        return (black + white, True)
+    return (white + black, False)
+
+def is_drawn_material(name: str) -> bool:
+    # bare kings, or a single minor piece against a bare king
+    return name in ("KK", "KBK", "KNK")
+
+class Ending():
+    '''
+    Maps the positions of one ending to table indices and back
+    '''
+    def __init__(self, name: str):
+        self.name = name
+        strong, weak = split_name(name)
+        # (color, piece type) of each piece, grouped by type, kings first
+        self.slots = [(chess.WHITE, chess.PIECE_SYMBOLS.index(symbol.lower())) for symbol in strong]
+        self.slots += [(chess.BLACK, chess.PIECE_SYMBOLS.index(symbol.lower())) for symbol in weak]
+        self.size = 2 * 32 * 64 ** (len(self.slots) - 1)
+        # slots following a slot with the same piece, whose squares must be ascending
+        self.repeated = [i for i in range(1, len(self.slots)) if self.slots[i] == self.slots[i - 1]]
+        self.pawns = [i for i, (_, piece_type) in enumerate(self.slots) if piece_type == chess.PAWN]
+
+    def squares(self, board: chess.Board) -> List[int]:
+        squares = []
+        for color, piece_type in self.slots:
+            if not squares or (color, piece_type) != previous:
+                squares.extend(chess.scan_forward(board.pieces_mask(piece_type, color)))
+            previous = (color, piece_type)
+        return squares
+
+    def index(self, board: chess.Board) -> int:
+        '''
+        Index of board, which must have the stronger side as white
+        '''
+        squares = self.squares(board)
+        if squares[0] & 7 >= 4:
+            squares = [square ^ 7 for square in squares]
+            # mirroring reverses the order of the pieces of the same type
+            for i in self.repeated:
+                j = i
+                while j > 0 and self.slots[j] == self.slots[j - 1] and squares[j] < squares[j - 1]:
+                    squares[j], squares[j - 1] = squares[j - 1], squares[j]
+                    j -= 1
+        index = (squares[0] >> 3) * 4 + (squares[0] & 7)
+        for square in squares[1:]:
+            index = index * 64 + square
+        return index * 2 + (board.turn == chess.BLACK)
+
+    def decode(self, index: int) -> Tuple[chess.Color, List[int]]:
+        turn = chess.BLACK if index & 1 else chess.WHITE
+        index >>= 1
+        squares = []
+        for _ in range(len(self.slots) - 1):
+            squares.append(index & 63)
+            index >>= 6
+        squares.append((index >> 2) * 8 + (index & 3))
+        squares.reverse()
+        return (turn, squares)
+
+    def set_up(self, board: chess.Board, index: int) -> bool:
+        '''
+        Puts the position of index on board, returns False if it isn't a legal
+        position (or not the canonical index of one)
+        '''
+        turn, squares = self.decode(index)
+        if len(set(squares)) != len(squares):
+            return False
+        for i in self.repeated:
+            if squares[i] < squares[i - 1]:
+                return False
+        for i in self.pawns:
+            if squares[i] < 8 or squares[i] >= 56:
+                return False
+        board.clear_board()
+        for (color, piece_type), square in zip(self.slots, squares):
+            board.set_piece_at(square, chess.Piece(piece_type, color))
+        board.turn = turn
+        # the side that just moved can't be in check
+        return not board.was_into_check()
+
+def pack(values: bytearray) -> bytearray:
+    packed = bytearray((len(values) + 3) // 4)
+    for i, value in enumerate(values):
+        packed[i >> 2] |= value << ((i & 3) * 2)
+    return packed
+
+def unpack(packed, size: int) -> bytearray:
+    return bytearray((packed[i >> 2] >> ((i & 3) * 2)) & 3 for i in range(size))
+
+def file_size(ending: "Ending") -> int:
+    return (ending.size + 3) // 4 + ending.size
+
+def table_path(directory: str, name: str) -> str:
+    return os.path.join(directory, f"{name}.bb")
+
+def generate(
+        name: str,
+        directory: str,
+        tables: Optional[Dict[str, Tuple[bytearray, bytearray]]] = None,
+        report: bool = True) -> Tuple[bytearray, bytearray]:
+    '''
+    Generates the table of ending name and the tables it depends on, writes
+    them to directory and returns the unpacked (values, distances). tables
+    holds those of the endings already generated.
+    '''
+    tables = tables if tables is not None else dict()
+    if name in tables:
+        return tables[name]
+    path = table_path(directory, name)
+    ending = get_ending(name)
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            data = file.read()
+        assert len(data) == file_size(ending), f"{path} has the wrong size, regenerate it"
+        packed_size = (ending.size + 3) // 4
+        tables[name] = (unpack(data[:packed_size], ending.size), bytearray(data[packed_size:]))
+        return tables[name]
+
+    # the endings reached by a capture or a promotion
+    strong, weak = split_name(name)
+    successors = set()
+    for side, other in ((strong, weak), (weak, strong)):
+        for i in range(1, len(side)):
+            successors.add(canonical_name(side[:i] + side[i + 1:], other)[0])
+            if side[i] == "P":
+                for promotion in "QRBN":
+                    # keep the side's pieces in canonical order
+                    pieces = sorted(side[1:i] + promotion + side[i + 1:], key="QRBNP".index)
+                    successors.add(canonical_name("K" + "".join(pieces), other)[0])
+    for successor in successors:
+        if not is_drawn_material(successor):
+            generate(successor, directory, tables, report)
+    board = chess.Board(None)
+
+    start = time.perf_counter()
+    values = bytearray(ending.size)
+    distances = bytearray([UNRESOLVED]) * ending.size
+    remaining = array('B', bytes(ending.size))
+    has_draw = bytearray(ending.size)
+    # a win through a capture or promotion has been queued
+    pending_win = bytearray(ending.size)
+    # the longest a loss can be dragged out so far
+    loss_distance = array('H', bytes(2 * ending.size))
+    edges_from = array('I')
+    edges_to = array('I')
+    # levels[d] lists the (index, value) found to be resolved in d plies
+    levels: List[List[Tuple[int, int]]] = [[]]
+
+    def queue(distance: int, index: int, value: int):
+        while len(levels) <= distance:
+            levels.append([])
+        levels[distance].append((index, value))
+
+    for index in range(ending.size):
+        if not ending.set_up(board, index):
+            values[index] = ILLEGAL
+            distances[index] = 0
+            continue
+        moves = 0
+        win_distance = None
+        for move in board.generate_legal_moves():
+            moves += 1
+            if move.promotion or board.is_capture(move):
+                board.push(move)
+                value, distance = probe_values(board, tables)
+                board.pop()
+                if value == LOSS:
+                    win_distance = distance + 1 if win_distance is None else min(win_distance, distance + 1)
+                elif value == DRAW:
+                    has_draw[index] = 1
+                else:
+                    loss_distance[index] = max(loss_distance[index], distance + 1)
+            else:
+                board.push(move)
+                edges_from.append(index)
+                edges_to.append(ending.index(board))
+                board.pop()
+                remaining[index] += 1
+        if moves == 0:
+            if board.is_check():
+                queue(0, index, LOSS)
+            else:
+                has_draw[index] = 1
+        elif win_distance is not None:
+            pending_win[index] = 1
+            queue(win_distance, index, WIN)
+        elif remaining[index] == 0 and not has_draw[index]:
+            # every move is a capture or promotion that loses
+            queue(loss_distance[index], index, LOSS)
+    scan_time = time.perf_counter() - start
+
+    # predecessors of every position, as offsets into a flat array
+    offsets = array('I', bytes(4 * (ending.size + 1)))
+    for child in edges_to:
+        offsets[child + 1] += 1
+    for i in range(ending.size):
+        offsets[i + 1] += offsets[i]
+    fill = array('I', offsets)
+    parents = array('I', bytes(4 * len(edges_to)))
+    for parent, child in zip(edges_from, edges_to):
+        parents[fill[child]] = parent
+        fill[child] += 1
+    del edges_from, edges_to, fill
+
+    # retrograde analysis, one distance at a time: a position is won in d + 1
+    # plies if some move reaches a position lost in d, and lost in d + 1 once
+    # every move reaches a position won for the opponent, the slowest in d
+    # (and no capture draws). Taking the positions in order of distance makes
+    # the first distance found for a position its shortest win or longest loss.
+    distance = 0
+    while distance < len(levels):
+        for child, value in levels[distance]:
+            if distances[child] != UNRESOLVED:
+                continue
+            values[child] = value
+            distances[child] = min(distance, MAX_DISTANCE)
+            for i in range(offsets[child], offsets[child + 1]):
+                parent = parents[i]
+                if distances[parent] != UNRESOLVED:
+                    continue
+                if value == LOSS:
+                    pending_win[parent] = 1
+                    queue(distance + 1, parent, WIN)
+                else:
+                    remaining[parent] -= 1
+                    loss_distance[parent] = max(loss_distance[parent], distance + 1)
+                    if remaining[parent] == 0 and not has_draw[parent] and not pending_win[parent]:
+                        queue(loss_distance[parent], parent, LOSS)
+        levels[distance] = []
+        distance += 1
+    # whatever is left is drawn
+    for index in range(ending.size):
+        if distances[index] == UNRESOLVED:
+            distances[index] = 0
+
+    os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", 'wb') as file:
+        file.write(pack(values))
+        file.write(distances)
+    os.replace(path + ".tmp", path)
+    tables[name] = (values, distances)
+    if report:
+        elapsed = time.perf_counter() - start
+        counts = [values.count(value) for value in (WIN, DRAW, LOSS, ILLEGAL)]
+        print(f"{name}: {ending.size} entries ({counts[0]} won, {counts[1]} drawn, {counts[2]} lost, {counts[3]} illegal), "
+              f"longest win {max(distances)} plies, generated in {elapsed:.1f}s ({scan_time:.1f}s move generation), "
+              f"{os.path.getsize(path)} bytes")
+    return tables[name]
+
+def probe_values(board: chess.Board, tables: Dict[str, Tuple[bytearray, bytearray]]) -> Tuple[int, int]:
+    '''
+    (value, distance) of board for its side to move from unpacked tables,
+    used during generation
+    '''
+    name, mirror = ending_name(board)
+    if is_drawn_material(name):
+        return (DRAW, 0)
+    if mirror:
+        board = board.mirror()
+    values, distances = tables[name]
+    index = get_ending(name).index(board)
+    return (values[index], distances[index])
+
+_endings: Dict[str, Ending] = dict()
+
+def get_ending(name: str) -> Ending:
+    if name not in _endings:
+        _endings[name] = Ending(name)
+    return _endings[name]
+
+class Bitbases():
+    '''
+    The tables found in a directory, memory-mapped and probed in place
+    '''
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.tables = dict()
+        self.max_pieces = 0
+        self.hits = 0
+        if not os.path.isdir(directory):
+            return
+        for file_name in sorted(os.listdir(directory)):
+            name, extension = os.path.splitext(file_name)
+            if extension != ".bb":
+                continue
+            ending = get_ending(name)
+            with open(os.path.join(directory, file_name), 'rb') as file:
+                table = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            assert len(table) == file_size(ending), f"{file_name} has the wrong size, regenerate it"
+            self.tables[name] = (ending, table)
+            self.max_pieces = max(self.max_pieces, len(ending.slots))
+
+    def __len__(self):
+        return len(self.tables)
+
+    def probe(self, board: chess.Board) -> Optional[int]:
+        '''
+        Returns 1 if board is won for the side to move, 0 if drawn and -1 if
+        lost, or None if there is no table for it
+        '''
+        result = self.probe_distance(board)
+        return result[0] if result is not None else None
+
+    def probe_distance(self, board: chess.Board) -> Optional[Tuple[int, int]]:
+        '''
+        Returns (result as for probe, plies to mate with best play), or None
+        if there is no table for board. The distance of a draw is 0.
+        '''
+        if chess.popcount(board.occupied) > self.max_pieces or board.castling_rights:
+            return None
+        name, mirror = ending_name(board)
+        if is_drawn_material(name):
+            return (0, 0)
+        if name not in self.tables:
+            return None
+        if board.ep_square is not None and board.has_legal_en_passant():
+            return None
+        ending, table = self.tables[name]
+        index = ending.index(board.mirror() if mirror else board)
+        value = (table[index >> 2] >> ((index & 3) * 2)) & 3
+        if value == ILLEGAL:
+            return None
+        self.hits += 1
+        return (wdl_values[value], table[(ending.size + 3) // 4 + index])
+
+    def close(self):
+        for _, table in self.tables.values():
+            table.close()
+        self.tables = dict()
+
+def check(directory: str, name: str, samples: int, seed: int = 0):
+    '''
+    Checks that sampled positions agree with the values and distances of
+    their moves
+    '''
+    bitbases = Bitbases(directory)
+    ending = get_ending(name)
+    rng = random.Random(seed)
+    board = chess.Board(None)
+    checked = 0
+    while checked < samples:
+        if not ending.set_up(board, rng.randrange(ending.size)):
+            continue
+        children = []
+        for move in board.legal_moves:
+            board.push(move)
+            value, distance = bitbases.probe_distance(board)
+            children.append((-value, distance + 1))
+            board.pop()
+        if not children:
+            expected = (-1, 0) if board.is_check() else (0, 0)
+        else:
+            value = max(value for value, _ in children)
+            distances = [distance for child, distance in children if child == value]
+            if value > 0:
+                expected = (value, min(distances))
+            elif value < 0:
+                expected = (value, max(distances))
+            else:
+                expected = (0, 0)
+        expected = (expected[0], min(expected[1], MAX_DISTANCE))
+        result = bitbases.probe_distance(board)
+        assert result == expected, f"{board.fen()}: {result} != {expected}"
+        checked += 1
+
+def probe_latency(bitbases: Bitbases, name: str, samples: int = 100000, seed: int = 0) -> float:
+    '''
+    Average time of Bitbases.probe in microseconds over random positions of ending name
+    '''
+    ending = get_ending(name)
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < min(samples, 1000):
+        board = chess.Board(None)
+        if ending.set_up(board, rng.randrange(ending.size)):
+            boards.append(board)
+    start = time.perf_counter()
+    for i in range(samples):
+        bitbases.probe(boards[i % len(boards)])
+    return (time.perf_counter() - start) / samples * 1e6
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate endgame bitbases")
+    parser.add_argument("--endings", default=",".join(DEFAULT_ENDINGS), help="e.g. KPK,KRK,KQK,KQKR")
+    parser.add_argument("--out", default="bitbases")
+    parser.add_argument("--check", type=int, default=0, metavar="N", help="verify N sampled positions of each table")
+    args = parser.parse_args()
+
+    tables = dict()
+    start = time.perf_counter()
+    for name in args.endings.split(","):
+        generate(name.strip().upper(), args.out, tables)
+    print(f"Generated in {time.perf_counter() - start:.1f}s")
+
+    bitbases = Bitbases(args.out)
+    for name, (_, table) in bitbases.tables.items():
+        print(f"{name}: {len(table)} bytes, probe {probe_latency(bitbases, name):.2f}us")
+        if args.check > 0:
+            check(args.out, name, args.check)
+            print(f"{name}: {args.check} sampled positions agree with their moves")
+    bitbases.close()
@@ -0,0 +1,271 @@
+import argparse
+import collections
+import multiprocessing
+import queue
+import socket
+import threading
+import time
+from multiprocessing.managers import BaseManager
+from typing import Any, Callable, Dict, Iterable, Tuple
+
+'''
+Coordinator/worker mode for tournaments, so that games can be spread over
+any number of machines instead of the cores of one.
+
+The coordinator builds the tournament exactly like bestchess.py and serves
+its games over a multiprocessing manager (plain TCP, authenticated with a
+shared key). Workers on any host connect, pull a game at a time, play it
+with simulate_game and send the result back:
+
+    python distributed.py coordinator --port 5555 --authkey secret
+    python distributed.py worker --host <coordinator> --port 5555 --authkey secret --processes 8
+
+The coordinator listens on all interfaces, pass --bind 127.0.0.1 (or the
+address of one interface) to restrict it.
+
+Workers send a heartbeat every HEARTBEAT_INTERVAL seconds. The games held
+by a worker that misses heartbeats for WORKER_TIMEOUT seconds are put back
+at the front of the queue. Every game has a task id and only the first
+result submitted for it is counted, so a game that was requeued and then
+finished twice (or finished by a worker that was presumed dead) is still
+counted exactly once.
+
+To try it on one box, let the coordinator start some local workers:
+
+    python distributed.py coordinator --local-workers 4
+'''
+
+HEARTBEAT_INTERVAL = 1.0
+WORKER_TIMEOUT = 10.0
+# returned by get_task once the tournament is over
+DONE = "done"
+
+class Coordinator():
+    '''
+    Task queue shared with the workers through the manager. All methods are
+    called from the manager's server threads, hence the lock.
+    '''
+    def __init__(self, worker_timeout: float = WORKER_TIMEOUT):
+        self.lock = threading.Lock()
+        self.worker_timeout = worker_timeout
+        self.tasks: Dict[int, Tuple[Callable, Any]] = dict()
+        self.pending = collections.deque()
+        # task id -> worker id currently playing it
+        self.in_flight: Dict[int, int] = dict()
+        self.finished = set()
+        self.results = queue.Queue()
+        self.heartbeats: Dict[int, float] = dict()
+        self.worker_names: Dict[int, str] = dict()
+        self.next_task_id = 0
+        self.next_worker_id = 0
+        self.closed = False
+
+    def add_task(self, fn: Callable, args) -> int:
+        with self.lock:
+            task_id = self.next_task_id
+            self.next_task_id += 1
+            self.tasks[task_id] = (fn, args)
+            self.pending.append(task_id)
+            return task_id
+
+    def register(self, name: str) -> int:
+        with self.lock:
+            worker_id = self.next_worker_id
+            self.next_worker_id += 1
+            self.worker_names[worker_id] = name
+            self.heartbeats[worker_id] = time.monotonic()
+            return worker_id
+
+    def heartbeat(self, worker_id: int):
+        with self.lock:
+            if worker_id in self.heartbeats:
+                self.heartbeats[worker_id] = time.monotonic()
+
+    def get_task(self, worker_id: int):
+        '''
+        Returns (task id, function, argument), None if there is nothing to do
+        right now, or DONE once the coordinator has shut down.
+        '''
+        self.check_workers()
+        with self.lock:
+            if self.closed:
+                self.heartbeats.pop(worker_id, None)
+                return DONE
+            self.heartbeats[worker_id] = time.monotonic()
+            while self.pending:
+                task_id = self.pending.popleft()
+                if task_id in self.finished:
+                    continue
+                self.in_flight[task_id] = worker_id
+                fn, args = self.tasks[task_id]
+                return (task_id, fn, args)
+            return None
+
+    def submit(self, worker_id: int, task_id: int, result) -> bool:
+        '''
+        Records the result of a task, returns False if it had already been counted
+        '''
+        with self.lock:
+            if self.closed or task_id in self.finished:
+                return False
+            self.finished.add(task_id)
+            self.in_flight.pop(task_id, None)
+            del self.tasks[task_id]
+            self.results.put(result)
+            return True
+
+    def check_workers(self):
+        '''
+        Requeues the tasks of workers that stopped sending heartbeats
+        '''
+        with self.lock:
+            now = time.monotonic()
+            dead = set(worker_id for worker_id, last in self.heartbeats.items() if now - last > self.worker_timeout)
+            for worker_id in dead:
+                print(f"Worker {self.worker_names[worker_id]} timed out, requeueing its games")
+                del self.heartbeats[worker_id]
+            for task_id, worker_id in list(self.in_flight.items()):
+                if worker_id in dead:
+                    del self.in_flight[task_id]
+                    self.pending.appendleft(task_id)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.pending.clear()
+
+    def num_workers(self) -> int:
+        with self.lock:
+            return len(self.heartbeats)
+
+class TournamentManager(BaseManager):
+    pass
+
+class DistributedPool():
+    '''
+    Stand-in for multiprocessing.Pool in the tournament functions of
+    bestchess.py, running imap_unordered on remote workers. Leaving the
+    context stops handing out games, like Pool.terminate.
+    '''
+    def __init__(self, address: Tuple[str, int], authkey: bytes):
+        self.coordinator = Coordinator()
+        TournamentManager.register("coordinator", callable=lambda: self.coordinator)
+        self.manager = TournamentManager(address=address, authkey=authkey)
+        self.server = self.manager.get_server()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def imap_unordered(self, fn: Callable, iterable: Iterable):
+        num_tasks = 0
+        for args in iterable:
+            self.coordinator.add_task(fn, args)
+            num_tasks += 1
+        for _ in range(num_tasks):
+            while True:
+                try:
+                    yield self.coordinator.results.get(timeout=HEARTBEAT_INTERVAL)
+                    break
+                except queue.Empty:
+                    self.coordinator.check_workers()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.coordinator.close()
+        # give the workers a chance to see DONE before the server goes away
+        deadline = time.monotonic() + 2 * HEARTBEAT_INTERVAL
+        while self.coordinator.num_workers() > 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+            self.coordinator.check_workers()
+
+def heartbeat_loop(coordinator, worker_id: int, stop: threading.Event):
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            coordinator.heartbeat(worker_id)
+        except (EOFError, OSError):
+            return
+
+def worker_loop(address: Tuple[str, int], authkey: bytes, name: str, connect_timeout: float = 30.0):
+    manager = TournamentManager(address=address, authkey=authkey)
+    TournamentManager.register("coordinator")
+    deadline = time.monotonic() + connect_timeout
+    while True:
+        try:
+            manager.connect()
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+    coordinator = manager.coordinator()
+    worker_id = coordinator.register(name)
+    stop = threading.Event()
+    threading.Thread(target=heartbeat_loop, args=(coordinator, worker_id, stop), daemon=True).start()
+
+    games_played = 0
+    try:
+        while True:
+            task = coordinator.get_task(worker_id)
+            if task == DONE:
+                break
+            if task is None:
+                time.sleep(0.2)
+                continue
+            task_id, fn, args = task
+            coordinator.submit(worker_id, task_id, fn(args))
+            games_played += 1
+    except (EOFError, OSError):
+        # the coordinator went away, which is how a finished tournament ends
+        pass
+    stop.set()
+    return games_played
+
+def run_workers(address: Tuple[str, int], authkey: bytes, processes: int):
+    host = socket.gethostname()
+    workers = [
+        multiprocessing.Process(target=worker_loop, args=(address, authkey, f"{host}-{i}"), daemon=True)
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
+
+if __name__ == "__main__":
+    from agent import MiniMaxAgent, RandomAgent, MinimaxAgentWithPieceSquareTables
+    from bestchess import build_pairs, run_sprt_tournament, run_tournament
+    from sprt import SPRT
+
+    parser = argparse.ArgumentParser(description="Play a tournament across several machines")
+    parser.add_argument("mode", choices=["coordinator", "worker"])
+    parser.add_argument("--host", default="localhost", help="address workers connect to")
+    parser.add_argument("--bind", default="0.0.0.0", help="address the coordinator listens on, all interfaces by default")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--authkey", default="cs221", help="shared secret between coordinator and workers")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="worker processes to run on this host")
+    parser.add_argument("--local-workers", type=int, default=0, help="worker processes the coordinator starts itself")
+    parser.add_argument("--games", type=int, default=256)
+    parser.add_argument("--chunks", type=int, default=4)
+    parser.add_argument("--sprt", action="store_true", help="stop early once the SPRT is decided")
+    parser.add_argument("--archive", default=None, help="archive every game to this path")
+    args = parser.parse_args()
+    authkey = args.authkey.encode()
+
+    if args.mode == "worker":
+        for worker in run_workers((args.host, args.port), authkey, args.processes):
+            worker.join()
+    else:
+        assert args.games % args.chunks == 0
+        agent1 = RandomAgent("RandAgent1")
+        agent2 = RandomAgent("RandAgent2")
+        # agent1 = MinimaxAgentWithPieceSquareTables("psquaretables", depth=2)
+        # agent2 = MiniMaxAgent("mma", depth=2)
+
+        pairs = build_pairs(agent1, agent2, args.games // args.chunks, args.chunks)
+        pool = DistributedPool((args.bind, args.port), authkey)
+        run_workers((args.host, args.port), authkey, args.local_workers)
+        if args.sprt:
+            sprt = SPRT(elo0=0, elo1=10, alpha=0.05, beta=0.05, pentanomial=True)
+            run_sprt_tournament(agent1, agent2, pairs, 0, sprt, args.archive, pool=pool)
+        else:
+            run_tournament(agent1, agent2, pairs, 0, args.archive, pool=pool)
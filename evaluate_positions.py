@@ -1,34 +1,53 @@
+import argparse
 import chess.engine
+import random
+import time
+from functools import partial
+from analysis import prefilter
 from multiprocessing import Pool
 from typing import List, Tuple
 from util import read_positions
 
+STOCKFISH_PATH = "/opt/homebrew/bin/stockfish"
+ENGINE_TIME = 1
+# positions whose shallow search score is further than this many pawns from
+# equal are discarded without asking Stockfish
+PREFILTER_MARGIN = 2.0
+
 def write_positions(file_path: str, positions: List[Tuple[str, str]]):
     with open(file_path, 'w') as file:
         for opening, fen in positions:
             file.write(opening + '\n')
             file.write(fen + '\n')
 
-def process_positions(chunk):
+def is_equivalent(engine: chess.engine.SimpleEngine, board: chess.Board) -> bool:
+    score = engine.analyse(board, chess.engine.Limit(time=ENGINE_TIME))["score"].relative
+    return not score.is_mate() and abs(score.score()) <= 20
+
+def process_positions(chunk, margin: float = PREFILTER_MARGIN):
     print(f"Chunk {chunk}: Reading positions...")
     
     positions = read_positions(f"positions/unprocessed/chunk_{chunk}.txt")
     
-    print(f"Chunk {chunk}: Finished reading positions...beginning evaluation...")
+    print(f"Chunk {chunk}: Finished reading positions...prefiltering...")
+
+    borderline, discarded = prefilter(positions, margin)
+
+    print(f"Chunk {chunk}: Prefilter discarded {len(discarded)}/{len(positions)} positions, "
+          f"saving ~{len(discarded) * ENGINE_TIME}s of engine time...beginning evaluation...")
     
-    engine = chess.engine.SimpleEngine.popen_uci("/opt/homebrew/bin/stockfish")
+    engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
     board = chess.Board()
 
     equivalent_positions = []
     count = 0
-    for opening, fen in positions:
+    for opening, fen in borderline:
         board.set_fen(fen)
-        score = engine.analyse(board, chess.engine.Limit(time=1))["score"].relative
-        if(not score.is_mate() and abs(score.score()) <= 20):
+        if is_equivalent(engine, board):
             equivalent_positions.append((opening, fen))
         count += 1
         if (count % 100 == 0):
-            print(f"Chunk {chunk}: Finished evaluating {count} positions...{len(positions)-count} more to go...")
+            print(f"Chunk {chunk}: Finished evaluating {count} positions...{len(borderline)-count} more to go...")
     
     print(f"Chunk {chunk}: Finished evaluating positions...outputting to file...")
     
@@ -39,7 +58,49 @@ def process_positions(chunk):
 
     print(f"Chunk {chunk}: Finished writing equivalent positions to file...")
 
+def calibrate(sample_size: int, margin: float, processes: int):
+    '''
+    Runs both the prefilter and Stockfish on a random sample of positions and
+    reports how much engine time the prefilter saves and how often it
+    discards a position Stockfish would have kept.
+    '''
+    positions = []
+    for chunk in range(1, 21):
+        positions.extend(read_positions(f"positions/unprocessed/chunk_{chunk}.txt"))
+    sample = random.sample(positions, sample_size)
+
+    start = time.perf_counter()
+    borderline, discarded = prefilter(sample, margin, processes=processes)
+    prefilter_time = time.perf_counter() - start
+
+    engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
+    board = chess.Board()
+    kept = set()
+    for opening, fen in sample:
+        board.set_fen(fen)
+        if is_equivalent(engine, board):
+            kept.add(fen)
+    engine.quit()
+
+    wrongly_discarded = sum(1 for _, fen in discarded if fen in kept)
+    print(f"Sample of {sample_size} positions, margin {margin} pawns")
+    print(f"Prefilter took {prefilter_time:.1f}s ({processes} processes)")
+    print(f"Prefilter discarded {len(discarded)} positions, saving {len(discarded) * ENGINE_TIME}s "
+          f"of {sample_size * ENGINE_TIME}s engine time ({100 * len(discarded) / sample_size:.1f}%)")
+    print(f"Stockfish kept {len(kept)} positions, {wrongly_discarded} of which the prefilter discarded "
+          f"({100 * wrongly_discarded / max(len(kept), 1):.1f}% of kept positions lost)")
+    print(f"Disagreement on discards: {100 * wrongly_discarded / max(len(discarded), 1):.1f}% of discarded positions were kept by Stockfish")
+
 if __name__ == "__main__":
-    with Pool(processes=10) as pool:
-        pool.map(process_positions, range(1, 21))
+    parser = argparse.ArgumentParser(description="Keep the positions that Stockfish scores within 20cp of equal")
+    parser.add_argument("--calibrate", type=int, default=0, metavar="N",
+                        help="instead of processing the chunks, compare the prefilter with Stockfish on N random positions")
+    parser.add_argument("--margin", type=float, default=PREFILTER_MARGIN)
+    parser.add_argument("--processes", type=int, default=10)
+    args = parser.parse_args()
 
+    if args.calibrate > 0:
+        calibrate(args.calibrate, args.margin, args.processes)
+    else:
+        with Pool(processes=args.processes) as pool:
+            pool.map(partial(process_positions, margin=args.margin), range(1, 21))
@@ -0,0 +1,276 @@
+import chess
+import mmap
+import os
+import struct
+import zlib
+from functools import lru_cache
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+from util import read_positions
+
+'''
+Compact, append-only archive of played games.
+
+An archive is two files:
+
+    <path>      blocks of zlib compressed games, each block starting with a
+                BLOCK_HEADER (magic, compressed size, number of games)
+    <path>.idx  one INDEX_ENTRY per game: (block offset, compressed block
+                size, offset of the game inside the block, game size)
+
+Blocks are only ever appended, and the index entries of a block are written
+after the block itself, so a crash can at worst leave an unindexed block at
+the end of the data file which readers never look at.
+
+Inside a block a game is stored as
+
+    GAME_HEADER     start kind, result, has evals/times, number of plies
+    names           white and black agent names (u8 length + utf-8)
+    start           nothing (standard position), a FEN (u8 length + ascii)
+                    or a book reference (u8 book, u8 chunk, u32 position)
+    moves           u16 per ply: from | to << 6 | promotion << 12
+    evals           i16 per ply, centipawns from white's point of view
+    times           u32 per ply, microseconds spent choosing the move
+'''
+
+MAGIC = b'FCAB'
+BLOCK_HEADER = struct.Struct('<4sII')
+INDEX_ENTRY = struct.Struct('<QIII')
+GAME_HEADER = struct.Struct('<BBBH')
+
+START_STANDARD = 0
+START_FEN = 1
+START_BOOK = 2
+
+# book references point into positions/<book>/chunk_<chunk>.txt
+books = ["unprocessed", "processed"]
+
+results = ["1-0", "0-1", "1/2-1/2", "*"]
+
+NO_EVAL = -32768
+MATE_EVAL = 32000
+
+class GameRecord(NamedTuple):
+    white: str
+    black: str
+    result: str # "1-0", "0-1", "1/2-1/2" or "*"
+    moves: List[chess.Move]
+    fen: Optional[str] = None # None for the standard starting position
+    book: Optional[Tuple[str, int, int]] = None # (book, chunk, index of the position in the chunk)
+    evals: Optional[List[Optional[float]]] = None # in pawns, from white's point of view
+    times: Optional[List[Optional[float]]] = None # in seconds
+
+    def starting_board(self) -> chess.Board:
+        if self.book is not None:
+            return chess.Board(book_position(*self.book)[1])
+        if self.fen is not None:
+            return chess.Board(self.fen)
+        return chess.Board()
+
+@lru_cache(maxsize=None)
+def read_book(book: str, chunk: int):
+    return read_positions(f"positions/{book}/chunk_{chunk}.txt")
+
+def book_position(book: str, chunk: int, index: int) -> Tuple[str, str]:
+    '''
+    Returns the (opening, fen) a book reference points to
+    '''
+    return read_book(book, chunk)[index]
+
+def encode_move(move: chess.Move) -> int:
+    promotion = move.promotion - 1 if move.promotion else 0
+    return move.from_square | (move.to_square << 6) | (promotion << 12)
+
+def decode_move(code: int) -> chess.Move:
+    promotion = code >> 12
+    return chess.Move(code & 63, (code >> 6) & 63, promotion + 1 if promotion else None)
+
+def encode_eval(score: Optional[float]) -> int:
+    if score is None:
+        return NO_EVAL
+    if score in (float('inf'), float('-inf')):
+        return MATE_EVAL if score > 0 else -MATE_EVAL
+    return max(-MATE_EVAL + 1, min(MATE_EVAL - 1, round(score * 100)))
+
+def decode_eval(code: int) -> Optional[float]:
+    if code == NO_EVAL:
+        return None
+    if abs(code) == MATE_EVAL:
+        return float('inf') if code > 0 else float('-inf')
+    return code / 100
+
+def encode_string(string: str) -> bytes:
+    data = string.encode('utf-8')[:255]
+    return bytes([len(data)]) + data
+
+def encode_game(game: GameRecord) -> bytes:
+    n = len(game.moves)
+    if game.book is not None:
+        start_kind = START_BOOK
+        book, chunk, index = game.book
+        start = struct.pack('<BBI', books.index(book), chunk, index)
+    elif game.fen is not None:
+        start_kind = START_FEN
+        start = encode_string(game.fen)
+    else:
+        start_kind = START_STANDARD
+        start = b''
+    flags = (1 if game.evals is not None else 0) | (2 if game.times is not None else 0)
+    data = [
+        GAME_HEADER.pack(start_kind, results.index(game.result), flags, n),
+        encode_string(game.white),
+        encode_string(game.black),
+        start,
+        struct.pack(f'<{n}H', *[encode_move(move) for move in game.moves]),
+    ]
+    if game.evals is not None:
+        data.append(struct.pack(f'<{n}h', *[encode_eval(score) for score in game.evals]))
+    if game.times is not None:
+        data.append(struct.pack(f'<{n}I', *[0xFFFFFFFF if t is None else min(round(t * 1e6), 0xFFFFFFFE) for t in game.times]))
+    return b''.join(data)
+
+def decode_string(data, offset: int) -> Tuple[str, int]:
+    length = data[offset]
+    return (bytes(data[offset + 1:offset + 1 + length]).decode('utf-8'), offset + 1 + length)
+
+def decode_header(data, offset: int = 0):
+    '''
+    Decodes everything but the per ply arrays, returns the partly filled
+    record, the number of plies, the flags and the offset of the moves
+    '''
+    start_kind, result, flags, n = GAME_HEADER.unpack_from(data, offset)
+    offset += GAME_HEADER.size
+    white, offset = decode_string(data, offset)
+    black, offset = decode_string(data, offset)
+    fen = None
+    book = None
+    if start_kind == START_BOOK:
+        book_id, chunk, index = struct.unpack_from('<BBI', data, offset)
+        book = (books[book_id], chunk, index)
+        offset += 6
+    elif start_kind == START_FEN:
+        fen, offset = decode_string(data, offset)
+    game = GameRecord(white=white, black=black, result=results[result], moves=[], fen=fen, book=book)
+    return (game, n, flags, offset)
+
+def decode_game(data, offset: int = 0) -> GameRecord:
+    game, n, flags, offset = decode_header(data, offset)
+    moves = [decode_move(code) for code in struct.unpack_from(f'<{n}H', data, offset)]
+    offset += 2 * n
+    evals = None
+    times = None
+    if flags & 1:
+        evals = [decode_eval(code) for code in struct.unpack_from(f'<{n}h', data, offset)]
+        offset += 2 * n
+    if flags & 2:
+        times = [None if t == 0xFFFFFFFF else t / 1e6 for t in struct.unpack_from(f'<{n}I', data, offset)]
+    return game._replace(moves=moves, evals=evals, times=times)
+
+class GameArchiveWriter():
+    def __init__(self, path: str, games_per_block: int = 256, level: int = 6):
+        self.data_file = open(path, 'ab')
+        self.index_file = open(path + '.idx', 'ab')
+        self.games_per_block = games_per_block
+        self.level = level
+        self.pending: List[bytes] = []
+
+    def add_game(self, game: GameRecord):
+        self.pending.append(encode_game(game))
+        if len(self.pending) >= self.games_per_block:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        payload = b''.join(self.pending)
+        compressed = zlib.compress(payload, self.level)
+        block_offset = self.data_file.seek(0, os.SEEK_END)
+        self.data_file.write(BLOCK_HEADER.pack(MAGIC, len(compressed), len(self.pending)))
+        self.data_file.write(compressed)
+        self.data_file.flush()
+
+        entries = []
+        offset = 0
+        for game in self.pending:
+            entries.append(INDEX_ENTRY.pack(block_offset, len(compressed), offset, len(game)))
+            offset += len(game)
+        self.index_file.write(b''.join(entries))
+        self.index_file.flush()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.data_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class GameArchiveReader():
+    def __init__(self, path: str):
+        self.data_file = open(path, 'rb')
+        self.index_file = open(path + '.idx', 'rb')
+        # mmap can't map empty files
+        self.data = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) > 0 else b''
+        self.index = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path + '.idx') > 0 else b''
+        self.num_games = len(self.index) // INDEX_ENTRY.size
+        self.cached_block = (None, None)
+
+    def __len__(self) -> int:
+        return self.num_games
+
+    def block(self, block_offset: int, length: int) -> bytes:
+        if self.cached_block[0] != block_offset:
+            start = block_offset + BLOCK_HEADER.size
+            magic, _, _ = BLOCK_HEADER.unpack_from(self.data, block_offset)
+            assert magic == MAGIC, f"corrupt archive block at {block_offset}"
+            self.cached_block = (block_offset, zlib.decompress(self.data[start:start + length]))
+        return self.cached_block[1]
+
+    def game_data(self, i: int) -> Tuple[bytes, int]:
+        if i < 0:
+            i += self.num_games
+        if not 0 <= i < self.num_games:
+            raise IndexError(f"game {i} out of range")
+        block_offset, length, offset, _ = INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)
+        return (self.block(block_offset, length), offset)
+
+    def game(self, i: int) -> GameRecord:
+        return decode_game(*self.game_data(i))
+
+    def __getitem__(self, i: int) -> GameRecord:
+        return self.game(i)
+
+    def __iter__(self) -> Iterator[GameRecord]:
+        # games are indexed in block order, so every block is only decompressed once
+        for i in range(self.num_games):
+            yield self.game(i)
+
+    def position(self, i: int, ply: int) -> chess.Board:
+        '''
+        Returns the board of game i after ply plies, decoding only the moves needed
+        '''
+        data, offset = self.game_data(i)
+        game, n, _, offset = decode_header(data, offset)
+        if not 0 <= ply <= n:
+            raise IndexError(f"game {i} has {n} plies")
+        board = game.starting_board()
+        for code in struct.unpack_from(f'<{ply}H', data, offset):
+            board.push(decode_move(code))
+        return board
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        if isinstance(self.index, mmap.mmap):
+            self.index.close()
+        self.data_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,11 +1,11 @@
 import chess
 import math
-import os, sys
+import os
+from typing import Optional
 
 # disable printing of "hello from the pygame community" message
-sys.stdout = open(os.devnull, 'w')
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
 import pygame
-sys.stdout = sys.__stdout__
 
 class ChessGraphics():
     def __init__(self, board: chess.Board, dimension: int = 800):
@@ -30,6 +30,11 @@ class ChessGraphics():
         self.pieces = self.initialize_pieces()
         self.moves = dict()
         self.last_move = None
+        # what is currently drawn on each square, see square_state
+        self.drawn = [None for _ in range(64)]
+        self.caption = 'Chess'
+        self.clock = pygame.time.Clock()
+        self.fps = 30
     
     def initialize_screen(self, dimension: int):
         screen = pygame.display.set_mode((dimension, dimension))
@@ -57,62 +62,75 @@ class ChessGraphics():
         return pieces
     
     def draw_game(self):
-        self.draw_board()
-        self.highlight_squares()
-        self.draw_last_move()
-        self.draw_pieces()
+        '''
+        Redraws only the squares whose contents changed since the last call
+        (pieces, move highlights, last move) and pushes just those rects to
+        the display, so an unchanged position costs next to nothing.
+        '''
+        dirty = []
+        for square in range(64):
+            state = self.square_state(square)
+            if self.drawn[square] != state:
+                self.drawn[square] = state
+                dirty.append(self.draw_square(square, state))
+        if dirty:
+            pygame.display.update(dirty)
     
     def draw_rect(self, color: chess.Color, row: int, col: int):
-        pygame.draw.rect(self.screen, color,(row*100, col*100, 100, 100))
+        return pygame.draw.rect(self.screen, color,(row*100, col*100, 100, 100))
 
     def get_position(self, square: int):
         row = square%8
         col = 7-square//8
         return (row, col)
-    
-    def draw_last_move_square(self, square):
-        if (square not in self.moves):
-            row, col = self.get_position(square)
-            color = self.TAN_YELLOW if (row%2 == col%2) else self.BROWN_YELLOW
-            self.draw_rect(color, row, col)
 
-    def draw_last_move(self):
-        if (self.last_move):
-            self.draw_last_move_square(self.last_move.from_square)
-            self.draw_last_move_square(self.last_move.to_square)
-    
-    def highlight_squares(self):
-        for square in self.moves:
-            row, col = self.get_position(square)
-            if (self.board.piece_at(square) is None):
-                color = self.TAN_GREEN if (row%2 == col%2) else self.BROWN_GREEN
-                pygame.draw.circle(self.screen, color, (100*row + 50, 100*col + 50), 10)
-            else:
-                circ_color = self.TAN if (row%2 == col%2) else self.BROWN
-                rect_color = self.TAN_GREEN if (row%2 == col%2) else self.BROWN_GREEN
-                self.draw_rect(rect_color, row, col)
-                pygame.draw.circle(self.screen, circ_color, (100*row + 50, 100*col + 50), 50, width=0)
+    def square_state(self, square: int):
+        piece = self.board.piece_at(square)
+        is_last_move = self.last_move is not None and square in (self.last_move.from_square, self.last_move.to_square)
+        return (str(piece) if piece is not None else None, square in self.moves, is_last_move)
 
-    def draw_board(self):
-        for i in range(8):
-            for j in range(8):
-                color = self.TAN if (i%2 == j%2) else self.BROWN
-                pygame.draw.rect(self.screen, color,(j*100, i*100, 100, 100))
-    
-    def draw_pieces(self):
+    def draw_square(self, square: int, state):
+        piece, is_target, is_last_move = state
+        row, col = self.get_position(square)
+        light = (row%2 == col%2)
+        if is_target and piece is not None:
+            # capture: green square with a board colored circle on top
+            rect = self.draw_rect(self.TAN_GREEN if light else self.BROWN_GREEN, row, col)
+            pygame.draw.circle(self.screen, self.TAN if light else self.BROWN, (100*row + 50, 100*col + 50), 50, width=0)
+        elif is_target:
+            rect = self.draw_rect(self.TAN if light else self.BROWN, row, col)
+            pygame.draw.circle(self.screen, self.TAN_GREEN if light else self.BROWN_GREEN, (100*row + 50, 100*col + 50), 10)
+        elif is_last_move:
+            rect = self.draw_rect(self.TAN_YELLOW if light else self.BROWN_YELLOW, row, col)
+        else:
+            rect = self.draw_rect(self.TAN if light else self.BROWN, row, col)
+        if piece is not None:
+            self.screen.blit(self.pieces[piece], (row*100, col*100))
+        return rect
+
+    def show_thinking(self, text: Optional[str]):
         '''
-        updates the screen basis the board class
+        Shows what an agent is thinking about in the window title, only
+        touching the window when the text changes.
         '''
-        
-        for i in range(64):
-            piece = self.board.piece_at(i)
-            if piece == None:
-                pass
-            else:
-                self.screen.blit(self.pieces[str(piece)],((i%8)*100,700-(i//8)*100))
+        caption = 'Chess' if text is None else f'Chess - {text}'
+        if caption != self.caption:
+            self.caption = caption
+            pygame.display.set_caption(caption)
 
-        pygame.display.flip()
+    def pump_events(self):
+        '''
+        Keeps the window responsive while an agent is to move, clicks are
+        ignored. Returns False once the window has been closed.
+        '''
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return False
+        return True
 
+    def wait_frame(self):
+        # cap the main loop so that an idle window uses next to no CPU
+        self.clock.tick(self.fps)
 
     def capture_human_interaction(self):
         for event in pygame.event.get():
@@ -125,8 +143,6 @@ class ChessGraphics():
 
             # if mouse clicked
             if event.type == pygame.MOUSEBUTTONDOWN:
-                #reset previous screen from clicks
-                self.screen.fill(self.BLACK)
                 #get position of mouse
                 pos = pygame.mouse.get_pos()
 
@@ -145,4 +161,4 @@ class ChessGraphics():
                         for move in list(self.board.legal_moves):
                             if move.from_square == index:
                                 self.moves[move.to_square] = move
-        return True
\ No newline at end of file
+        return True
@@ -0,0 +1,249 @@
+import chess
+import math
+import multiprocessing
+import random
+import time
+from agent import Agent, MiniMaxAgent, initialize_piece_count
+from array import array
+from game_archive import decode_move, encode_move
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+
+'''
+Monte Carlo tree search agent using PUCT selection and the minimax agents'
+evaluation (eval_board) for leaf values, squashed into [-1, 1] by tanh.
+Optionally a few random plies are played out from the leaf before it is
+evaluated.
+
+The tree is kept in flat arrays indexed by node number rather than one
+Python object per node. The children of a node are allocated next to each
+other when it is expanded, so a node only needs the index of its first
+child and its number of children.
+
+With processes > 1 the search is parallelised at the root: every process
+grows its own tree from the current position for the same time (or its
+share of the playouts), and the visits and values of the root moves are
+summed over the trees before picking the move. The evaluation is pure
+Python, so threads sharing one tree gain nothing under the GIL, while
+processes add throughput. The trees other than the first add Dirichlet
+noise to their root priors, so that they explore different moves instead
+of all growing the same tree. A process pool can't be started from a pool
+worker (such as a tournament game in bestchess.py), so there the agent
+searches in a single process.
+'''
+
+def _search_process(data) -> List[Tuple[int, int, float]]:
+    agent, board, deadline, playouts, seed = data
+    agent.board = board
+    return agent.search(deadline, playouts, seed)
+
+class MCTSAgent(Agent):
+    def __init__(
+            self,
+            name: str,
+            time_limit: Optional[float] = None,
+            playouts: Optional[int] = None,
+            processes: int = 1,
+            c_puct: float = 1.5,
+            playout_depth: int = 0,
+            eval_scale: float = 4.0,
+            root_noise: float = 0.25):
+        super().__init__(name)
+        # a second per move unless a budget is given, a playout budget alone
+        # runs all of its playouts however long they take
+        if time_limit is None and playouts is None:
+            time_limit = 1.0
+        self.time_limit = time_limit
+        self.playouts = playouts
+        self.processes = processes
+        self.c_puct = c_puct
+        self.playout_depth = playout_depth
+        # a score of eval_scale pawns maps to a value of tanh(1) ~ 0.76
+        self.eval_scale = eval_scale
+        # share of the root priors replaced by noise in the trees other than the first
+        self.root_noise = root_noise
+        # only used for its evaluation function, so weights work as for MiniMaxAgent
+        self.evaluator = MiniMaxAgent(name, depth=0)
+        self.weights = self.evaluator.weights
+        self.rng = random.Random()
+        # started on the first move that searches in several processes
+        self.pool = None
+        self.reset_tree()
+
+    def reset_tree(self):
+        self.parent = array('i', [-1])
+        self.move = array('H', [0])
+        self.first_child = array('i', [-1])
+        self.num_children = array('H', [0])
+        self.expanded = array('b', [0])
+        self.visits = array('i', [0])
+        # from the point of view of the player who made the move into the node
+        self.value = array('d', [0.0])
+        self.prior = array('f', [1.0])
+        self.completed = 0
+
+    def __getstate__(self):
+        # pools can't be pickled, and the tree is rebuilt every move anyway
+        state = dict(self.__dict__)
+        state["pool"] = None
+        return state
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def evaluate(self, board: chess.Board) -> float:
+        '''
+        Value of a non-terminal leaf in [-1, 1] from white's point of view
+        '''
+        score = self.evaluator.eval_board(board, initialize_piece_count(board))
+        return math.tanh(score / self.eval_scale)
+
+    def terminal_value(self, board: chess.Board) -> Optional[float]:
+        if board.is_checkmate():
+            return -1.0 if board.turn == chess.WHITE else 1.0
+        if board.is_stalemate() or board.is_insufficient_material() or board.is_fifty_moves() or board.is_repetition(3):
+            return 0.0
+        return None
+
+    def priors(self, board: chess.Board, moves: List[chess.Move]) -> List[float]:
+        # cheap move ordering: captures and promotions are worth a closer look
+        weights = [1.0 + 2.0 * board.is_capture(move) + 2.0 * (move.promotion is not None) for move in moves]
+        total = sum(weights)
+        return [w / total for w in weights]
+
+    def expand(self, node: int, board: chess.Board):
+        moves = list(board.legal_moves)
+        first = len(self.parent)
+        self.parent.extend([node] * len(moves))
+        self.move.extend(encode_move(move) for move in moves)
+        self.first_child.extend([-1] * len(moves))
+        self.num_children.extend([0] * len(moves))
+        self.expanded.extend([0] * len(moves))
+        self.visits.extend([0] * len(moves))
+        self.value.extend([0.0] * len(moves))
+        self.prior.extend(self.priors(board, moves))
+        self.first_child[node] = first
+        self.num_children[node] = len(moves)
+        self.expanded[node] = 1
+
+    def select_child(self, node: int) -> int:
+        sqrt_visits = math.sqrt(max(self.visits[node], 1))
+        best = -1
+        best_score = float('-inf')
+        first = self.first_child[node]
+        for child in range(first, first + self.num_children[node]):
+            visits = self.visits[child]
+            q = self.value[child] / visits if visits > 0 else 0.0
+            score = q + self.c_puct * self.prior[child] * sqrt_visits / (1 + visits)
+            if score > best_score:
+                best_score = score
+                best = child
+        return best
+
+    def add_root_noise(self, seed: int):
+        self.rng.seed(seed)
+        first = self.first_child[0]
+        children = range(first, first + self.num_children[0])
+        noise = [self.rng.gammavariate(0.3, 1.0) for _ in children]
+        total = sum(noise) or 1.0
+        for child, n in zip(children, noise):
+            self.prior[child] = (1 - self.root_noise) * self.prior[child] + self.root_noise * n / total
+
+    def playout(self, board: chess.Board):
+        '''
+        Runs one selection/expansion/evaluation/backup cycle from the root
+        position on board, leaving board as it found it
+        '''
+        path = [0]
+        node = 0
+        while self.expanded[node] and self.num_children[node] > 0:
+            node = self.select_child(node)
+            board.push(decode_move(self.move[node]))
+            path.append(node)
+        value = self.terminal_value(board) if len(path) > 1 else None
+        if value is None:
+            if not self.expanded[node]:
+                self.expand(node, board)
+            value = self.rollout(board)
+
+        # back the value up the path. value is from white's point of view, so
+        # a node reached by a white move stores it as is and one reached by a
+        # black move negated
+        for node in reversed(path[1:]):
+            board.pop()
+            self.visits[node] += 1
+            self.value[node] += value if board.turn == chess.WHITE else -value
+        self.visits[0] += 1
+        self.completed += 1
+
+    def rollout(self, board: chess.Board) -> float:
+        played = 0
+        value = None
+        for _ in range(self.playout_depth):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(self.rng.choice(moves))
+            played += 1
+            value = self.terminal_value(board)
+            if value is not None:
+                break
+        if value is None:
+            value = self.evaluate(board)
+        for _ in range(played):
+            board.pop()
+        return value
+
+    def search(self, deadline: Optional[float], playouts: Optional[int], seed: Optional[int] = None) -> List[Tuple[int, int, float]]:
+        '''
+        Grows a tree from self.board until deadline (a time.monotonic() time)
+        or after playouts playouts, returns (move, visits, value) of the root
+        moves. With a seed the root priors get noise.
+        '''
+        self.reset_tree()
+        root = self.board.copy()
+        self.expand(0, root)
+        if seed is not None and self.root_noise > 0:
+            self.add_root_noise(seed)
+        while (deadline is None or time.monotonic() < deadline) and (playouts is None or self.completed < playouts):
+            self.playout(root)
+        first = self.first_child[0]
+        return [(self.move[child], self.visits[child], self.value[child]) for child in range(first, first + self.num_children[0])]
+
+    def get_move(self):
+        moves = list(self.board.legal_moves)
+        if len(moves) == 1:
+            return moves[0]
+        deadline = time.monotonic() + self.time_limit if self.time_limit is not None else None
+        processes = self.processes if not multiprocessing.current_process().daemon else 1
+
+        if processes > 1:
+            if self.pool is None:
+                self.pool = Pool(processes=processes - 1)
+            self.reset_tree()
+            share = self.playouts // processes if self.playouts is not None else None
+            seeds = [self.rng.getrandbits(64) for _ in range(processes - 1)]
+            helpers = self.pool.map_async(_search_process, [(self, self.board, deadline, share, seed) for seed in seeds])
+            trees = [self.search(deadline, self.playouts - share * (processes - 1) if share is not None else None)]
+            trees.extend(helpers.get())
+        else:
+            trees = [self.search(deadline, self.playouts)]
+
+        # sum the root statistics over the trees
+        totals: Dict[int, List] = dict()
+        for tree in trees:
+            for move, visits, value in tree:
+                total = totals.setdefault(move, [0, 0.0])
+                total[0] += visits
+                total[1] += value
+        self.completed = sum(visits for visits, _ in totals.values())
+        best = max(totals, key=lambda move: totals[move][0])
+        visits, value = totals[best]
+        # as for MiniMaxAgent, the score of the chosen move in pawns from white's point of view
+        q = value / max(visits, 1)
+        q = max(min(q, 0.999), -0.999)
+        mover_sign = 1 if self.board.turn == chess.WHITE else -1
+        self.last_score = mover_sign * self.eval_scale * math.atanh(q)
+        return decode_move(best)
@@ -0,0 +1,109 @@
+import chess
+import random
+from array import array
+from pawn_shield_storm import eval_pawn_storm
+from typing import List
+
+'''
+Hash table for evaluation terms that only depend on where the pawns and the
+two kings are, keyed by a Zobrist key over just those pieces. The search
+updates the key incrementally with update_pawn_key, and since pawns and
+kings move far less often than everything else, most leaves find their
+terms already in the table.
+
+To cache another pawn/king term (e.g. the pawn shield sketched at the top
+of pawn_shield_storm.py), add its name to pawn_terms and compute it in
+evaluate_pawn_terms.
+'''
+
+pawn_terms = ["pawn_storm"]
+
+def evaluate_pawn_terms(board: chess.Board) -> List[float]:
+    return [eval_pawn_storm(board)]
+
+# zobrist_keys[color][0][square] for pawns, zobrist_keys[color][1][square] for kings
+_random = random.Random(221)
+zobrist_keys = [[[_random.getrandbits(64) for _ in range(64)] for _ in range(2)] for _ in range(2)]
+
+def pawn_key(board: chess.Board) -> int:
+    key = 0
+    for color in chess.COLORS:
+        pawns, kings = zobrist_keys[color]
+        for square in chess.scan_forward(board.pawns & board.occupied_co[color]):
+            key ^= pawns[square]
+        for square in chess.scan_forward(board.kings & board.occupied_co[color]):
+            key ^= kings[square]
+    return key
+
+def update_pawn_key(key: int, board: chess.Board, move: chess.Move) -> int:
+    '''
+    Returns the pawn key after move, must be called before the move is pushed
+    '''
+    color = board.turn
+    pawns, kings = zobrist_keys[color]
+    piece_type = board.piece_type_at(move.from_square)
+    if piece_type == chess.PAWN:
+        key ^= pawns[move.from_square]
+        if not move.promotion:
+            key ^= pawns[move.to_square]
+        if board.is_en_passant(move):
+            key ^= zobrist_keys[not color][0][move.to_square - 8 if color == chess.WHITE else move.to_square + 8]
+    elif piece_type == chess.KING:
+        key ^= kings[move.from_square] ^ kings[move.to_square]
+    if board.pawns & board.occupied_co[not color] & chess.BB_SQUARES[move.to_square]:
+        key ^= zobrist_keys[not color][0][move.to_square]
+    return key
+
+class PawnHashTable():
+    '''
+    Fixed size, always-replace table. Keys and terms live in flat arrays of
+    machine words (8 bytes per key plus 8 bytes per term and entry) rather
+    than in a dict of Python objects. Lookups from several threads are
+    safe, though the hit and miss counts may be slightly off.
+    '''
+    def __init__(self, size: int = 1 << 16):
+        assert size & (size - 1) == 0, "size must be a power of two"
+        self.size = size
+        self.mask = size - 1
+        self.num_terms = len(pawn_terms)
+        # key 0 marks an empty slot, a real key of 0 is just never a hit
+        self.keys = array('Q', bytes(8 * size))
+        self.terms = array('d', bytes(8 * size * self.num_terms))
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_megabytes(cls, megabytes: int):
+        entries = (megabytes << 20) // (8 + 8 * len(pawn_terms))
+        return cls(1 << max(entries.bit_length() - 1, 0))
+
+    def lookup(self, key: int, board: chess.Board) -> List[float]:
+        '''
+        Returns the pawn/king terms for board, computing and storing them on a miss
+        '''
+        index = key & self.mask
+        start = index * self.num_terms
+        if key != 0 and self.keys[index] == key:
+            terms = self.terms[start:start + self.num_terms].tolist()
+            # if the key changed while the terms were read, another thread
+            # sharing the table was overwriting the entry
+            if self.keys[index] == key:
+                self.hits += 1
+                return terms
+        self.misses += 1
+        terms = evaluate_pawn_terms(board)
+        # empty the slot while its terms are rewritten, so that a reader
+        # checking the key again after reading them sees the change
+        self.keys[index] = 0
+        self.terms[start:start + self.num_terms] = array('d', terms)
+        self.keys[index] = key
+        return terms
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def clear(self):
+        self.keys = array('Q', bytes(8 * self.size))
+        self.hits = 0
+        self.misses = 0
@@ -1,5 +1,4 @@
 import chess
-import numpy as np
 
 # Piece-square tables for opening and endgame stages
 # Opening tables
@@ -122,9 +121,9 @@ def game_phase(piece_count, player):
 
     endgameStartWeight = 2 * rookEndgameWeight + 2 * bishopEndgameWeight + 2 * knightEndgameWeight + queenEndgameWeight
     if player == chess.WHITE:
-        endgameWeightSum = np.dot(piece_count[6:], transition_weights)
+        endgameWeightSum = sum(c * w for c, w in zip(piece_count[6:], transition_weights))
     else:
-        endgameWeightSum = np.dot(piece_count[:6], transition_weights)
+        endgameWeightSum = sum(c * w for c, w in zip(piece_count[:6], transition_weights))
     endgameT = 1 - min(1, endgameWeightSum / endgameStartWeight)
     return endgameT
     
@@ -0,0 +1,198 @@
+import argparse
+import chess
+import random
+import time
+from multiprocessing import Pool, cpu_count
+from typing import Dict, Optional
+
+'''
+Bulk random playouts: plays thousands of uniformly random games from a
+position and aggregates the results, for baselines and rollout based
+evaluation.
+
+Each ply costs one pseudo-legal move generation, a legality check of the
+drawn move and one push. The termination
+rules are the same as board.outcome() (checkmate, stalemate, insufficient
+material, seventy-five moves, fivefold repetition), but checked cheaply:
+mate and stalemate fall out of the move generation, insufficient material
+can only arise after a capture or promotion, and repetitions are counted
+in a dict that is cleared at every irreversible move, so only positions
+since the last pawn move or capture are ever compared.
+'''
+
+terminations = ["checkmate", "stalemate", "insufficient_material", "seventyfive_moves", "fivefold_repetition", "max_plies"]
+
+def new_stats() -> Dict:
+    return {
+        "games": 0,
+        "white": 0,
+        "draws": 0,
+        "black": 0,
+        "plies": 0,
+        "plies_squared": 0,
+        "min_plies": None,
+        "max_plies": None,
+        "terminations": {termination: 0 for termination in terminations},
+    }
+
+def merge_stats(stats: Dict, other: Dict) -> Dict:
+    for key in ("games", "white", "draws", "black", "plies", "plies_squared"):
+        stats[key] += other[key]
+    for key, pick in (("min_plies", min), ("max_plies", max)):
+        if other[key] is not None:
+            stats[key] = other[key] if stats[key] is None else pick(stats[key], other[key])
+    for termination in terminations:
+        stats["terminations"][termination] += other["terminations"][termination]
+    return stats
+
+def position_key(board: chess.Board):
+    # what makes two positions the same for repetitions, as in python-chess
+    return (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+            board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK],
+            board.turn, board.castling_rights, board.ep_square)
+
+def play_random_game(board: chess.Board, rng: random.Random, max_plies: Optional[int] = None):
+    '''
+    Plays random moves on board until the game ends, returns
+    (winner or None, termination, plies played)
+    '''
+    seen = {position_key(board): 1}
+    insufficient = board.is_insufficient_material()
+    repetition = False
+    occupied = chess.popcount(board.occupied)
+    plies = 0
+    while True:
+        # pick uniformly among the pseudo-legal moves and reject illegal ones,
+        # which is still uniform over the legal moves but only checks the
+        # legality of the moves actually drawn
+        moves = list(board.generate_pseudo_legal_moves())
+        move = None
+        while moves:
+            i = int(rng.random() * len(moves))
+            if not board.is_into_check(moves[i]):
+                move = moves[i]
+                break
+            moves[i] = moves[-1]
+            moves.pop()
+        if move is None:
+            if board.is_check():
+                return (not board.turn, "checkmate", plies)
+            return (None, "stalemate", plies)
+        if insufficient:
+            return (None, "insufficient_material", plies)
+        if board.halfmove_clock >= 150:
+            return (None, "seventyfive_moves", plies)
+        if repetition:
+            return (None, "fivefold_repetition", plies)
+        if max_plies is not None and plies >= max_plies:
+            return (None, "max_plies", plies)
+
+        board.push(move)
+        plies += 1
+
+        if board.halfmove_clock == 0:
+            # pawn move or capture, no earlier position can repeat
+            seen.clear()
+        key = position_key(board)
+        count = seen.get(key, 0) + 1
+        seen[key] = count
+        repetition = count >= 5
+
+        if move.promotion or chess.popcount(board.occupied) != occupied:
+            occupied = chess.popcount(board.occupied)
+            insufficient = board.is_insufficient_material()
+
+def random_playouts(fen: str = chess.STARTING_FEN, num_games: int = 1000, seed: Optional[int] = None, max_plies: Optional[int] = None) -> Dict:
+    '''
+    Plays num_games random games from fen, returns the aggregated statistics
+    '''
+    rng = random.Random(seed)
+    start = chess.Board(fen)
+    stats = new_stats()
+    for _ in range(num_games):
+        board = start.copy(stack=False)
+        winner, termination, plies = play_random_game(board, rng, max_plies)
+        stats["games"] += 1
+        if winner is None:
+            stats["draws"] += 1
+        elif winner == chess.WHITE:
+            stats["white"] += 1
+        else:
+            stats["black"] += 1
+        stats["plies"] += plies
+        stats["plies_squared"] += plies * plies
+        stats["min_plies"] = plies if stats["min_plies"] is None else min(stats["min_plies"], plies)
+        stats["max_plies"] = plies if stats["max_plies"] is None else max(stats["max_plies"], plies)
+        stats["terminations"][termination] += 1
+    return stats
+
+def _playout_batch(args):
+    return random_playouts(*args)
+
+def random_playouts_parallel(
+        fen: str = chess.STARTING_FEN,
+        num_games: int = 1000,
+        processes: int = cpu_count(),
+        seed: Optional[int] = None,
+        max_plies: Optional[int] = None,
+        batch_size: int = 100) -> Dict:
+    '''
+    Same as random_playouts, with the games split into batches over a process pool
+    '''
+    rng = random.Random(seed)
+    batches = []
+    remaining = num_games
+    while remaining > 0:
+        batches.append((fen, min(batch_size, remaining), rng.getrandbits(64), max_plies))
+        remaining -= batch_size
+    stats = new_stats()
+    with Pool(processes=processes) as pool:
+        for batch in pool.imap_unordered(_playout_batch, batches):
+            merge_stats(stats, batch)
+    return stats
+
+def summarize(stats: Dict) -> str:
+    games = max(stats["games"], 1)
+    mean = stats["plies"] / games
+    std = max(stats["plies_squared"] / games - mean * mean, 0) ** 0.5
+    ended = ', '.join(f"{name} {count}" for name, count in stats["terminations"].items() if count > 0)
+    return (f"{stats['games']} games: +{stats['white']} ={stats['draws']} -{stats['black']} (white's point of view), "
+            f"length {mean:.1f} +/- {std:.1f} plies [{stats['min_plies']}, {stats['max_plies']}], ended by {ended}")
+
+def benchmark(fen: str, num_games: int):
+    '''
+    Compares the playout engine with RandomAgent vs RandomAgent through ChessGame
+    '''
+    from agent import RandomAgent
+    from bestchess import ChessGame
+
+    start = time.perf_counter()
+    for _ in range(num_games):
+        ChessGame(RandomAgent("white"), RandomAgent("black"), useGraphics=False, startingFen=fen).run()
+    slow = time.perf_counter() - start
+
+    start = time.perf_counter()
+    random_playouts(fen, num_games)
+    fast = time.perf_counter() - start
+
+    print(f"ChessGame:       {num_games / slow:8.1f} games/s")
+    print(f"random_playouts: {num_games / fast:8.1f} games/s ({slow / fast:.1f}x faster)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play random games from a position")
+    parser.add_argument("--fen", default=chess.STARTING_FEN)
+    parser.add_argument("--games", type=int, default=10000)
+    parser.add_argument("--processes", type=int, default=cpu_count())
+    parser.add_argument("--max-plies", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--benchmark", type=int, default=0, metavar="N", help="compare with ChessGame on N games")
+    args = parser.parse_args()
+
+    if args.benchmark > 0:
+        benchmark(args.fen, args.benchmark)
+    else:
+        start = time.perf_counter()
+        stats = random_playouts_parallel(args.fen, args.games, args.processes, args.seed, args.max_plies)
+        elapsed = time.perf_counter() - start
+        print(summarize(stats))
+        print(f"{stats['games'] / elapsed:.1f} games/s, {stats['plies'] / elapsed:.0f} plies/s")
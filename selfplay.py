@@ -0,0 +1,228 @@
+import argparse
+import chess
+import chess.polyglot
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from agent import MiniMaxAgent
+from game_archive import MATE_EVAL, encode_eval
+from multiprocessing import Pool, cpu_count
+from typing import Dict, List, Optional, Tuple
+from util import read_positions
+
+'''
+Self-play generator for (position, search score, game result) training data.
+
+Each game starts from a random opening in positions/processed, plays a
+few random plies to diversify the games, and then lets a MiniMaxAgent play
+against itself. Every position the agent searched is recorded with the
+score of its search (pawns, white's point of view) and the final result
+(1 white win, 0.5 draw, 0 black win).
+
+Positions are deduplicated and streamed to gzip compressed shards of
+shard_size positions each, described by a manifest.json that is rewritten
+after every shard. Memory stays flat however many games are played: only
+a bounded number of games is in flight, and deduplication uses a fixed
+size Bloom filter (which may drop a tiny fraction of unseen positions as
+false duplicates, but never lets a duplicate through).
+'''
+
+# score is in pawns from white's point of view, rounded to centipawns as in
+# game_archive.encode_eval: forced mates are written as +/-MATE_SCORE and
+# every other score (including bitbase wins) is clamped to within 0.01 of it
+SHARD_FORMAT = "fen;score;result"
+MATE_SCORE = MATE_EVAL / 100
+
+class PositionFilter():
+    '''
+    Fixed size Bloom filter over 64-bit position keys
+    '''
+    def __init__(self, bits: int = 1 << 27, hashes: int = 3):
+        assert bits & (bits - 1) == 0, "bits must be a power of two"
+        self.mask = bits - 1
+        self.hashes = hashes
+        self.array = bytearray(bits // 8)
+
+    def add(self, key: int) -> bool:
+        '''
+        Adds key, returns False if it (probably) was already there
+        '''
+        h1 = key & 0xFFFFFFFF
+        h2 = (key >> 32) | 1
+        new = False
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) & self.mask
+            if not self.array[bit >> 3] & (1 << (bit & 7)):
+                self.array[bit >> 3] |= 1 << (bit & 7)
+                new = True
+        return new
+
+class ShardWriter():
+    def __init__(self, directory: str, shard_size: int, config: Dict):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.shard_size = shard_size
+        self.manifest = {
+            "format": SHARD_FORMAT,
+            "mate_score": MATE_SCORE,
+            "config": config,
+            "shards": [],
+            "games": 0,
+            "positions": 0,
+            "duplicates": 0,
+        }
+        self.file = None
+        self.in_shard = 0
+
+    def write(self, fen: str, score: float, result: float):
+        if self.file is None:
+            name = f"shard_{len(self.manifest['shards']):05d}.txt.gz"
+            self.file = gzip.open(os.path.join(self.directory, name), 'wt')
+            self.manifest["shards"].append({"file": name, "positions": 0})
+        self.file.write(f"{fen};{score};{result}\n")
+        self.in_shard += 1
+        self.manifest["positions"] += 1
+        if self.in_shard == self.shard_size:
+            self.close_shard()
+
+    def close_shard(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        self.manifest["shards"][-1]["positions"] = self.in_shard
+        self.in_shard = 0
+        self.write_manifest()
+
+    def write_manifest(self):
+        path = os.path.join(self.directory, "manifest.json")
+        with open(path + ".tmp", 'w') as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        self.close_shard()
+        self.write_manifest()
+
+def play_game(data) -> Tuple[List[Tuple[int, str, float]], float]:
+    '''
+    Plays one self-play game, returns ([(position key, fen, score)], result)
+    '''
+    fen, depth, weights, random_plies, max_plies, seed = data
+    rng = random.Random(seed)
+    board = chess.Board(fen)
+    for _ in range(rng.randint(0, random_plies)):
+        moves = list(board.legal_moves)
+        if not moves:
+            break
+        board.push(rng.choice(moves))
+
+    agent = MiniMaxAgent("selfplay", depth=depth)
+    agent.weights.update(weights)
+    positions = []
+    plies = 0
+    while board.outcome() is None and plies < max_plies:
+        # re-initialize every move so that the piece count matches the board
+        agent.initialize(board)
+        move = agent.get_move()
+        positions.append((chess.polyglot.zobrist_hash(board), board.fen(), encode_eval(agent.last_score) / 100))
+        board.push(move)
+        plies += 1
+
+    outcome = board.outcome()
+    if outcome is None or outcome.winner is None:
+        # games that hit max_plies are counted as draws
+        result = 0.5
+    else:
+        result = 1.0 if outcome.winner == chess.WHITE else 0.0
+    return (positions, result)
+
+def generate(
+        num_games: int,
+        directory: str,
+        depth: int = 1,
+        weights: Optional[Dict[str, float]] = None,
+        random_plies: int = 8,
+        max_plies: int = 300,
+        shard_size: int = 100000,
+        processes: int = cpu_count(),
+        seed: int = 0):
+    from tqdm import tqdm
+    weights = weights or {}
+    openings = []
+    for chunk in range(1, 21):
+        openings.extend(fen for _, fen in read_positions(f"positions/processed/chunk_{chunk}.txt"))
+    rng = random.Random(seed)
+
+    config = {"depth": depth, "weights": weights, "random_plies": random_plies, "max_plies": max_plies, "seed": seed}
+    writer = ShardWriter(directory, shard_size, config)
+    seen = PositionFilter()
+
+    # Pool consumes its input as fast as it can, so bound the number of games
+    # queued ahead of the results being written
+    in_flight = threading.BoundedSemaphore(4 * processes)
+    def tasks():
+        for _ in range(num_games):
+            in_flight.acquire()
+            yield (rng.choice(openings), depth, weights, random_plies, max_plies, rng.getrandbits(64))
+
+    start = time.perf_counter()
+    searched = 0
+    with Pool(processes=processes) as pool:
+        with tqdm(total=num_games, desc=f"Self-play {num_games} games") as pbar:
+            for positions, result in pool.imap_unordered(play_game, tasks()):
+                in_flight.release()
+                writer.manifest["games"] += 1
+                searched += len(positions)
+                for key, fen, score in positions:
+                    if seen.add(key):
+                        writer.write(fen, score, result)
+                    else:
+                        writer.manifest["duplicates"] += 1
+                elapsed = time.perf_counter() - start
+                pbar.set_postfix_str(f"{writer.manifest['positions'] / elapsed:.0f} positions/s")
+                pbar.update(1)
+    writer.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"{writer.manifest['games']} games, {searched} positions searched, "
+          f"{writer.manifest['positions']} written ({writer.manifest['duplicates']} duplicates) "
+          f"to {len(writer.manifest['shards'])} shards in {elapsed:.1f}s")
+    print(f"{searched / elapsed:.1f} positions/s searched, {writer.manifest['positions'] / elapsed:.1f} positions/s written")
+
+def read_shard(path: str):
+    '''
+    Yields (fen, score, result) from a shard
+    '''
+    with gzip.open(path, 'rt') as file:
+        for line in file:
+            fen, score, result = line.rstrip('\n').split(';')
+            yield (fen, float(score), float(result))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate training data by self-play")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--out", default="selfplay_data")
+    parser.add_argument("--depth", type=int, default=1, help="agent depth in moves, as for MiniMaxAgent")
+    parser.add_argument("--weights", default="", help='e.g. "piece_count=1,pawn_storm=0.1"')
+    parser.add_argument("--random-plies", type=int, default=8, help="play up to this many random plies after the opening")
+    parser.add_argument("--max-plies", type=int, default=300)
+    parser.add_argument("--shard-size", type=int, default=100000, help="positions per shard")
+    parser.add_argument("--processes", type=int, default=cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from uci import parse_weights
+    generate(
+        num_games=args.games,
+        directory=args.out,
+        depth=args.depth,
+        weights=parse_weights(args.weights),
+        random_plies=args.random_plies,
+        max_plies=args.max_plies,
+        shard_size=args.shard_size,
+        processes=args.processes,
+        seed=args.seed)
@@ -0,0 +1,134 @@
+import math
+from typing import Optional, Tuple
+
+'''
+Sequential probability ratio test for A/B testing agents, in the style of
+fishtest. Results are added as they come in, and the test stops as soon as
+the log-likelihood ratio (LLR) of H1 (elo = elo1) against H0 (elo = elo0)
+crosses one of the bounds:
+
+    LLR <= log(beta / (1 - alpha))  -> accept H0, the change is not an improvement
+    LLR >= log((1 - beta) / alpha)  -> accept H1, the change is an improvement
+
+The LLR uses the usual normal approximation (GSPRT). With pentanomial
+statistics every sample is the average score of a game pair (the same
+opening played with both colors), which cancels most of the opening bias
+and needs noticeably fewer games than counting single games (trinomial).
+'''
+
+# added to every count when estimating the variance, as fishtest does, so
+# that samples which all score the same (a sweep, or nothing but draws)
+# still give a small but non-zero variance rather than none at all
+PSEUDO_COUNT = 1e-3
+
+def expected_score(elo: float) -> float:
+    return 1 / (1 + 10 ** (-elo / 400))
+
+def elo_from_score(score: float) -> float:
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+class SPRT():
+    def __init__(self, elo0: float = 0, elo1: float = 5, alpha: float = 0.05, beta: float = 0.05, pentanomial: bool = True, min_samples: int = 16):
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+        self.pentanomial = pentanomial
+        # the variance estimate is unreliable over the first few samples, and
+        # a lucky start could otherwise cross a bound straight away
+        self.min_samples = min_samples
+        # pentanomial: number of pairs scoring 0, 0.5, 1, 1.5, 2
+        # trinomial: number of losses, draws, wins
+        self.counts = [0] * 5 if pentanomial else [0] * 3
+
+    def add_game(self, score: float):
+        '''
+        Adds a single game, score is 1 for a win, 0.5 for a draw and 0 for a loss
+        '''
+        assert not self.pentanomial
+        self.counts[round(score * 2)] += 1
+
+    def add_pair(self, score1: float, score2: float):
+        '''
+        Adds both games of an opening pair. In trinomial mode they are
+        added as two independent games.
+        '''
+        if self.pentanomial:
+            self.counts[round((score1 + score2) * 2)] += 1
+        else:
+            self.add_game(score1)
+            self.add_game(score2)
+
+    def games(self) -> int:
+        return sum(self.counts) * (2 if self.pentanomial else 1)
+
+    def stats(self) -> Tuple[int, float, float]:
+        '''
+        Returns (number of samples, mean score, variance of a sample)
+        '''
+        n = sum(self.counts)
+        if n == 0:
+            return (0, 0.5, 0)
+        counts = [c + PSEUDO_COUNT for c in self.counts]
+        total = sum(counts)
+        values = [i / (len(counts) - 1) for i in range(len(counts))]
+        mean = sum(c * v for c, v in zip(counts, values)) / total
+        var = sum(c * (v - mean) ** 2 for c, v in zip(counts, values)) / total
+        return (n, mean, var)
+
+    def llr(self) -> float:
+        n, mean, var = self.stats()
+        if n < 2:
+            return 0
+        s0 = expected_score(self.elo0)
+        s1 = expected_score(self.elo1)
+        return (s1 - s0) * (2 * mean - s0 - s1) * n / (2 * var)
+
+    def status(self) -> Optional[str]:
+        '''
+        Returns "H0" or "H1" once a bound has been crossed, None while undecided
+        '''
+        if sum(self.counts) < self.min_samples:
+            return None
+        llr = self.llr()
+        if llr <= self.lower:
+            return "H0"
+        if llr >= self.upper:
+            return "H1"
+        return None
+
+    def elo(self) -> Tuple[float, float]:
+        '''
+        Returns the Elo estimate and its 95% error bar
+        '''
+        n, mean, var = self.stats()
+        if n == 0:
+            return (0, float('inf'))
+        stderr = math.sqrt(var / n)
+        low = elo_from_score(mean - 1.96 * stderr)
+        high = elo_from_score(mean + 1.96 * stderr)
+        return (elo_from_score(mean), (high - low) / 2)
+
+    def summary(self) -> str:
+        elo, error = self.elo()
+        return (f"LLR {self.llr():.2f} [{self.lower:.2f}, {self.upper:.2f}] "
+                f"Elo {elo:.1f} +/- {error:.1f} ({self.games()} games)")
+
+def check():
+    '''
+    Checks the degenerate cases where every sample scores the same
+    '''
+    for pentanomial in (True, False):
+        for pair, expected in (((1, 1), "H1"), ((0, 0), "H0"), ((0.5, 0.5), "H0"), ((1, 0), "H0")):
+            sprt = SPRT(elo0=0, elo1=10, pentanomial=pentanomial)
+            pairs = 0
+            while sprt.status() is None and pairs < 100000:
+                sprt.add_pair(*pair)
+                pairs += 1
+            assert sprt.status() == expected, f"{pair} pairs ({'penta' if pentanomial else 'tri'}nomial): {sprt.status()}, {sprt.summary()}"
+            assert 0 < sprt.elo()[1] < float('inf'), sprt.summary()
+            print(f"{pair} pairs ({'penta' if pentanomial else 'tri'}nomial): {expected} after {pairs} pairs, {sprt.summary()}")
+
+if __name__ == "__main__":
+    check()
@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+'''
+Tournament telemetry: spans for every game, move and search iteration,
+recorded inside the pool workers, shipped to the parent in one batch per
+game, and exported as a Chrome trace (open it in chrome://tracing or
+https://ui.perfetto.dev) plus a summary table.
+
+Recording is off unless a worker was set up with init_worker, and every
+hook checks `recorder is not None` first, so it costs next to nothing
+when unused.
+'''
+
+class Recorder():
+    '''
+    Collects spans in a worker and ships them to the parent through queue
+    '''
+    def __init__(self, queue, batch_size: int = 10000):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.spans = []
+        self.pid = os.getpid()
+
+    def add(self, name: str, category: str, start: float, end: float, args: Dict):
+        self.spans.append((name, category, start, end, self.pid, threading.get_ident(), args))
+        if len(self.spans) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.spans:
+            self.queue.put(self.spans)
+            self.spans = []
+
+# the recorder of this process, None when telemetry is off
+recorder: Optional[Recorder] = None
+
+def init_worker(queue):
+    '''
+    Pool initializer turning telemetry on in a worker
+    '''
+    global recorder
+    recorder = Recorder(queue)
+
+def now() -> float:
+    # monotonic_ns is system wide, so timestamps from different workers line up
+    return time.monotonic_ns() / 1000
+
+def record(name: str, category: str, start: float, end: float, **args):
+    if recorder is not None:
+        recorder.add(name, category, start, end, args)
+
+@contextmanager
+def span(name: str, category: str, **args):
+    '''
+    Records the enclosed block, args can still be added to while inside it
+    '''
+    if recorder is None:
+        yield args
+        return
+    start = now()
+    try:
+        yield args
+    finally:
+        recorder.add(name, category, start, now(), args)
+
+def flush():
+    if recorder is not None:
+        recorder.flush()
+
+def game_phase(num_pieces: int) -> str:
+    if num_pieces > 24:
+        return "opening"
+    if num_pieces > 12:
+        return "middlegame"
+    return "endgame"
+
+class Collector():
+    '''
+    Drains the spans shipped by the workers on a background thread. Without
+    a queue it starts a manager for one: a manager queue survives workers
+    being terminated mid-put (as when an SPRT stops early), which could
+    leave a half written message in a multiprocessing.Queue.
+    '''
+    def __init__(self, queue = None):
+        self.manager = None
+        if queue is None:
+            import multiprocessing
+            self.manager = multiprocessing.Manager()
+            queue = self.manager.Queue()
+        self.queue = queue
+        self.spans = []
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            self.spans.extend(batch)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.manager is not None:
+            self.manager.shutdown()
+
+    def export_chrome_trace(self, path: str):
+        events = []
+        for pid in sorted(set(span[4] for span in self.spans)):
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"worker {pid}"}})
+        for name, category, start, end, pid, tid, args in self.spans:
+            events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start,
+                "dur": end - start,
+                "pid": pid,
+                "tid": tid,
+                "args": args,
+            })
+        with open(path, 'w') as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+    def summary(self, top: int = 10) -> str:
+        games = [span for span in self.spans if span[1] == "game"]
+        moves = [span for span in self.spans if span[1] == "move"]
+        if not games:
+            return "No games recorded"
+        lines = []
+
+        # worker utilisation: share of the tournament each worker spent in games
+        begin = min(span[2] for span in games)
+        end = max(span[3] for span in games)
+        wall = end - begin
+        busy = defaultdict(float)
+        last_end = dict()
+        for _, _, start, stop, pid, _, _ in games:
+            busy[pid] += stop - start
+            last_end[pid] = max(last_end.get(pid, 0), stop)
+        lines.append(f"{len(games)} games over {wall / 1e6:.1f}s on {len(busy)} workers, "
+                     f"utilisation {100 * sum(busy.values()) / (wall * len(busy)):.1f}%")
+        first_idle = min(last_end.values())
+        lines.append(f"Straggler tail: {(end - first_idle) / 1e6:.1f}s between the first worker running out of games and the last game ending")
+        lines.append("")
+
+        def table(title: str, key):
+            groups = defaultdict(list)
+            for move in moves:
+                groups[key(move)].append(move)
+            lines.append(f"{title:<24} {'moves':>7} {'total s':>9} {'ms/move':>9} {'nodes':>9} {'depth':>6} {'eval %':>7}")
+            for group, spans in sorted(groups.items(), key=lambda item: -sum(s[3] - s[2] for s in item[1])):
+                total = sum(s[3] - s[2] for s in spans)
+                nodes = [s[6]["nodes"] for s in spans if s[6].get("nodes") is not None]
+                depths = [s[6]["depth"] for s in spans if s[6].get("depth") is not None]
+                eval_time = sum(s[6].get("eval_time") or 0 for s in spans)
+                lines.append(f"{str(group)[:24]:<24} {len(spans):>7} {total / 1e6:>9.2f} {total / 1e3 / len(spans):>9.2f} "
+                             f"{(sum(nodes) / len(nodes) if nodes else 0):>9.0f} {(sum(depths) / len(depths) if depths else 0):>6.1f} "
+                             f"{100 * eval_time * 1e6 / max(total, 1):>7.1f}")
+            lines.append("")
+
+        table("agent", lambda move: move[6]["agent"])
+        table("phase", lambda move: move[6]["phase"])
+
+        lines.append(f"{'opening (by time)':<40} {'games':>6} {'total s':>9}")
+        by_opening = defaultdict(list)
+        for game in games:
+            by_opening[game[6].get("opening")].append(game[3] - game[2])
+        for opening, durations in sorted(by_opening.items(), key=lambda item: -sum(item[1]))[:top]:
+            lines.append(f"{str(opening)[:40]:<40} {len(durations):>6} {sum(durations) / 1e6:>9.2f}")
+        lines.append("")
+
+        lines.append(f"{'slowest games':<40} {'plies':>6} {'s':>9}  result")
+        for game in sorted(games, key=lambda game: game[2] - game[3])[:top]:
+            lines.append(f"{str(game[6].get('opening'))[:40]:<40} {game[6].get('plies', 0):>6} {(game[3] - game[2]) / 1e6:>9.2f}  {game[6].get('result')}")
+        return '\n'.join(lines)
@@ -0,0 +1,266 @@
+import chess
+import sys
+import threading
+import time
+from agent import BITBASE_WIN, MiniMaxAgent, MinimaxAgentWithPieceSquareTables
+from bitbase import MAX_DISTANCE, Bitbases
+from pawn_hash import PawnHashTable
+from typing import Dict, List, Optional
+
+'''
+UCI front-end for the minimax agents, so they can be run as a long-lived
+engine process by match runners (cutechess-cli, fastchess) and GUIs:
+
+    cutechess-cli -engine cmd="python uci.py" ... -engine cmd=stockfish ...
+
+It can also be driven from python-chess:
+
+    engine = chess.engine.SimpleEngine.popen_uci([sys.executable, "uci.py"])
+    engine.configure({"Weights": "piece_count=1,piece_square=1"})
+    engine.play(board, chess.engine.Limit(time=0.5))
+'''
+
+ENGINE_NAME = "cs221-minimax"
+ENGINE_AUTHOR = "cs221-project_flynn"
+
+agent_classes = {
+    "MiniMaxAgent": MiniMaxAgent,
+    "MinimaxAgentWithPieceSquareTables": MinimaxAgentWithPieceSquareTables,
+}
+
+MAX_DEPTH = 64
+MATE_SCORE = 30000
+
+def parse_weights(value: str) -> Dict[str, float]:
+    '''
+    Parses "piece_count=1,pawn_storm=0.5" into a weights dictionary.
+    '''
+    weights = {}
+    for item in value.replace(';', ',').split(','):
+        if item.strip() == '':
+            continue
+        key, weight = item.split('=')
+        weights[key.strip()] = float(weight)
+    return weights
+
+def allocate_time(board: chess.Board, limits: Dict[str, int], overhead: float) -> Optional[float]:
+    '''
+    Returns the number of seconds to think for, or None if there is no time limit.
+    '''
+    if "movetime" in limits:
+        return max(0.001, limits["movetime"] / 1000 - overhead)
+    remaining = limits.get("wtime" if board.turn == chess.WHITE else "btime")
+    if remaining is None:
+        return None
+    increment = limits.get("winc" if board.turn == chess.WHITE else "binc", 0)
+    moves_to_go = limits.get("movestogo", 30)
+    budget = remaining / moves_to_go + 0.75 * increment
+    # never use more than half of what is left on the clock
+    budget = min(budget, remaining / 2)
+    return max(0.001, budget / 1000 - overhead)
+
+class UciEngine():
+    def __init__(self, output=sys.stdout):
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.board = chess.Board()
+        self.options = {
+            "Agent": "MiniMaxAgent",
+            "Depth": 4,
+            "Weights": "",
+            "Hash": 16,
+            "Move Overhead": 30,
+            "Bitbases": "",
+        }
+        self.pawn_table: Optional[PawnHashTable] = None
+        self.bitbases: Optional[Bitbases] = None
+        self.search_thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+
+    def send(self, line: str):
+        with self.output_lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+
+    def make_agent(self) -> MiniMaxAgent:
+        agent = agent_classes[self.options["Agent"]](ENGINE_NAME, depth=self.options["Depth"] // 2)
+        agent.weights.update(parse_weights(self.options["Weights"]))
+        # the pawn hash table is kept between searches, Hash sets its size
+        if self.pawn_table is None:
+            self.pawn_table = PawnHashTable.from_megabytes(self.options["Hash"])
+        agent.pawn_table = self.pawn_table
+        # as are the memory-mapped bitbases
+        if self.options["Bitbases"]:
+            if self.bitbases is None:
+                self.bitbases = Bitbases(self.options["Bitbases"])
+            agent.bitbase_dir = self.options["Bitbases"]
+            agent.bitbases = self.bitbases
+        return agent
+
+    def handle(self, line: str) -> bool:
+        '''
+        Handles a single line of input, returns False once the engine should exit.
+        '''
+        tokens = line.split()
+        if len(tokens) == 0:
+            return True
+        command = tokens[0]
+        if command == "uci":
+            self.send(f"id name {ENGINE_NAME}")
+            self.send(f"id author {ENGINE_AUTHOR}")
+            agent_vars = ' '.join(f"var {name}" for name in agent_classes)
+            self.send(f"option name Agent type combo default MiniMaxAgent {agent_vars}")
+            self.send(f"option name Depth type spin default 4 min 1 max {MAX_DEPTH}")
+            self.send("option name Weights type string default <empty>")
+            self.send("option name Hash type spin default 16 min 1 max 4096")
+            self.send("option name Move Overhead type spin default 30 min 0 max 5000")
+            self.send("option name Bitbases type string default <empty>")
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "setoption":
+            self.set_option(tokens[1:])
+        elif command == "ucinewgame":
+            self.stop()
+            self.board = chess.Board()
+            if self.pawn_table is not None:
+                self.pawn_table.clear()
+        elif command == "position":
+            self.stop()
+            self.set_position(tokens[1:])
+        elif command == "go":
+            self.stop()
+            self.go(tokens[1:])
+        elif command == "stop":
+            self.stop()
+        elif command == "quit":
+            self.stop()
+            return False
+        return True
+
+    def set_option(self, tokens: List[str]):
+        # setoption name <id> [value <x>], where both <id> and <x> may contain spaces
+        if "value" in tokens:
+            split = tokens.index("value")
+            name, value = ' '.join(tokens[1:split]), ' '.join(tokens[split + 1:])
+        else:
+            name, value = ' '.join(tokens[1:]), ""
+        if name not in self.options:
+            self.send(f"info string unknown option {name}")
+            return
+        if isinstance(self.options[name], int):
+            self.options[name] = int(value)
+            if name == "Hash":
+                self.pawn_table = None
+        elif name == "Weights":
+            value = "" if value == "<empty>" else value
+            parse_weights(value)
+            self.options[name] = value
+        elif name == "Bitbases":
+            self.options[name] = "" if value == "<empty>" else value
+            self.bitbases = None
+        elif name == "Agent":
+            if value not in agent_classes:
+                self.send(f"info string unknown agent {value}")
+                return
+            self.options[name] = value
+
+    def set_position(self, tokens: List[str]):
+        moves = tokens.index("moves") if "moves" in tokens else len(tokens)
+        if tokens[0] == "startpos":
+            board = chess.Board()
+        else:
+            board = chess.Board(' '.join(tokens[1:moves]))
+        for uci in tokens[moves + 1:]:
+            board.push_uci(uci)
+        self.board = board
+
+    def go(self, tokens: List[str]):
+        limits = {}
+        i = 0
+        while i < len(tokens):
+            if tokens[i] in ("depth", "movetime", "wtime", "btime", "winc", "binc", "movestogo", "nodes"):
+                limits[tokens[i]] = int(tokens[i + 1])
+                i += 2
+            else:
+                # infinite, ponder, searchmoves are not supported beyond searching until stop
+                if tokens[i] == "infinite":
+                    limits["infinite"] = 1
+                i += 1
+
+        board = self.board.copy()
+        time_limit = allocate_time(board, limits, self.options["Move Overhead"] / 1000)
+        if "depth" in limits:
+            max_depth = limits["depth"]
+        elif time_limit is not None or "infinite" in limits or "nodes" in limits:
+            max_depth = MAX_DEPTH
+        else:
+            max_depth = self.options["Depth"]
+
+        self.stop_event.clear()
+        self.search_thread = threading.Thread(
+            target=self.search,
+            args=(board, max_depth, time_limit, limits.get("nodes")),
+            daemon=True)
+        self.search_thread.start()
+
+    def search(self, board: chess.Board, max_depth: int, time_limit: Optional[float], node_limit: Optional[int]):
+        start = time.monotonic()
+        deadline = start + time_limit if time_limit is not None else None
+        agent = self.make_agent()
+        agent.initialize(board)
+        mate_depth = None
+
+        def should_stop():
+            if self.stop_event.is_set():
+                return True
+            if node_limit is not None and agent.nodes >= node_limit:
+                return True
+            return deadline is not None and time.monotonic() >= deadline
+
+        def on_iteration(depth: int, score: float, move: chess.Move):
+            nonlocal mate_depth
+            elapsed = time.monotonic() - start
+            sign = 1 if board.turn == chess.WHITE else -1
+            if score in (float('inf'), float('-inf')):
+                # the first iteration that sees the mate gives its distance
+                mate_depth = depth if mate_depth is None else mate_depth
+                moves_to_mate = (mate_depth + 1) // 2
+                score_str = f"mate {moves_to_mate if score * sign > 0 else -moves_to_mate}"
+            elif abs(score) >= BITBASE_WIN - MAX_DISTANCE:
+                # a bitbase win, BITBASE_WIN less the distance to mate in plies
+                # after the root move (exact when the root is in the tables)
+                moves_to_mate = (BITBASE_WIN - abs(score) + 2) // 2
+                score_str = f"mate {moves_to_mate if score * sign > 0 else -moves_to_mate}"
+            else:
+                score_str = f"cp {round(100 * score * sign)}"
+            pv = f" pv {move.uci()}" if move is not None else ""
+            self.send(f"info depth {depth} score {score_str} nodes {agent.nodes} "
+                      f"time {int(elapsed * 1000)} nps {int(agent.nodes / max(elapsed, 1e-6))}{pv}")
+            # don't start an iteration we are unlikely to finish
+            if deadline is not None and time.monotonic() - start > (deadline - start) / 2:
+                self.stop_event.set()
+
+        agent.should_stop = should_stop
+        _, move, _ = agent.iterative_deepening(max_depth, on_iteration=on_iteration)
+        if move is None:
+            # stopped before depth 1 finished, any legal move beats forfeiting
+            move = next(iter(board.legal_moves), None)
+        if agent.pawn_table.hits + agent.pawn_table.misses > 0:
+            self.send(f"info string pawn hash hit rate {100 * agent.pawn_table.hit_rate():.1f}%")
+        self.send(f"bestmove {move.uci() if move is not None else '0000'}")
+
+    def stop(self):
+        if self.search_thread is not None:
+            self.stop_event.set()
+            self.search_thread.join()
+            self.search_thread = None
+
+def main():
+    engine = UciEngine()
+    for line in sys.stdin:
+        if not engine.handle(line):
+            break
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import chess
+import random
+
+'''
+Zobrist keys of whole positions (pieces, side to move, castling rights and
+en passant square), for detecting repetitions. The search updates the key
+incrementally with update_key instead of hashing every node from scratch.
+
+Unlike chess.polyglot.zobrist_hash, the en passant square is hashed after
+every double pawn push whether or not a capture is possible. That never
+hides a repetition: a position right after a double push is the first one
+since an irreversible move, so no earlier position can equal it anyway.
+'''
+
+_random = random.Random(8191)
+# piece_keys[color][piece type][square]
+piece_keys = [[[_random.getrandbits(64) for _ in range(64)] for _ in range(7)] for _ in range(2)]
+castling_keys = [_random.getrandbits(64) for _ in range(64)]
+ep_keys = [_random.getrandbits(64) for _ in range(8)]
+turn_key = _random.getrandbits(64)
+
+def zobrist_key(board: chess.Board) -> int:
+    key = turn_key if board.turn == chess.WHITE else 0
+    for square, piece in board.piece_map().items():
+        key ^= piece_keys[piece.color][piece.piece_type][square]
+    for square in chess.scan_forward(board.castling_rights):
+        key ^= castling_keys[square]
+    if board.ep_square is not None:
+        key ^= ep_keys[chess.square_file(board.ep_square)]
+    return key
+
+def update_key(key: int, board: chess.Board, move: chess.Move) -> int:
+    '''
+    Returns the key after move, must be called before the move is pushed
+    '''
+    color = board.turn
+    keys = piece_keys[color]
+    piece_type = board.piece_type_at(move.from_square)
+    key ^= turn_key ^ keys[piece_type][move.from_square]
+
+    if piece_type == chess.KING and board.is_castling(move):
+        rank = move.from_square & ~7
+        if move.to_square > move.from_square:
+            king_to, rook_from, rook_to = rank + 6, rank + 7, rank + 5
+        else:
+            king_to, rook_from, rook_to = rank + 2, rank, rank + 3
+        key ^= keys[chess.KING][king_to] ^ keys[chess.ROOK][rook_from] ^ keys[chess.ROOK][rook_to]
+    else:
+        captured = board.piece_type_at(move.to_square)
+        if captured is not None:
+            key ^= piece_keys[not color][captured][move.to_square]
+        elif piece_type == chess.PAWN and move.to_square == board.ep_square:
+            key ^= piece_keys[not color][chess.PAWN][move.to_square - 8 if color == chess.WHITE else move.to_square + 8]
+        key ^= keys[move.promotion or piece_type][move.to_square]
+
+    # castling rights are lost when the king moves or anything moves from or to a rook's square
+    rights = board.castling_rights & ~chess.BB_SQUARES[move.from_square] & ~chess.BB_SQUARES[move.to_square]
+    if piece_type == chess.KING:
+        rights &= ~(chess.BB_RANK_1 if color == chess.WHITE else chess.BB_RANK_8)
+    for square in chess.scan_forward(board.castling_rights ^ rights):
+        key ^= castling_keys[square]
+
+    if board.ep_square is not None:
+        key ^= ep_keys[chess.square_file(board.ep_square)]
+    if piece_type == chess.PAWN and abs(move.to_square - move.from_square) == 16:
+        key ^= ep_keys[chess.square_file(move.from_square)]
+    return key